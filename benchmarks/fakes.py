@@ -0,0 +1,562 @@
+"""
+Local stand-ins for S3, the Docker daemon API and the Kubernetes API server,
+just enough of each for kubbuilder_service to run a job end to end
+"""
+import copy
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = io.BytesIO()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body.write(self.rfile.read(size))
+                self.rfile.readline()
+            return body.getvalue()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_json(self, code, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_chunked(self, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def write_chunk(self, data):
+        self.wfile.write(("%x\r\n" % len(data)).encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def start_server(handler_class, **attrs):
+    handler = type(handler_class.__name__, (handler_class,), attrs)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%s" % server.server_address[1]
+
+
+# S3
+
+def make_archive(size):
+    """
+    Builds an executor zip of roughly size bytes: Dockerfile.nlu, the training
+    csv files read for memory sizing and a random, so unique and incompressible, model blob
+    """
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr('Dockerfile.nlu', "FROM python:3.5-jessie\nWORKDIR /app\nCOPY . /app\n"
+                                           "RUN pip install -r requirements.txt\nCMD [\"python\", \"app.py\"]\n")
+        zip_ref.writestr('requirements.txt', "flask==0.12.2\n")
+        zip_ref.writestr('intent_train.csv', "text,intent\n" + "hello,greet\n" * 1000)
+        zip_ref.writestr('entity.csv', "value,entity\n" + "paris,city\n" * 1000)
+        zip_ref.writestr('model/model.bin', os.urandom(max(size, 0)),
+                         compress_type=zipfile.ZIP_STORED)
+    return buf.getvalue()
+
+
+class S3Handler(FakeHandler):
+    objects = None
+    latency = 0
+
+    def find(self):
+        path = urlparse(self.path).path
+        return self.objects.get(path.lstrip('/'))
+
+    def do_HEAD(self):
+        time.sleep(self.latency)
+        data = self.find()
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', '"%s"' % hashlib.md5(data).hexdigest())
+        self.end_headers()
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        data = self.find()
+        if data is None:
+            self.send_json(404, {})
+            return
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        first, last = (int(match.group(1)), int(match.group(2))) if match else (0, len(data) - 1)
+        body = data[first:last + 1]
+        self.send_response(206 if match else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"%s"' % hashlib.md5(data).hexdigest())
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_s3(objects, latency=0):
+    """
+    objects maps "bucket/key" to the object bytes
+    """
+    return start_server(S3Handler, objects=objects, latency=latency)
+
+
+# Docker daemon
+
+class DockerHandler(FakeHandler):
+    state = None
+    build_latency = 0
+    push_latency = 0
+    layer_size = 0
+
+    def route(self):
+        return re.sub(r'^/v[0-9.]+', '', urlparse(self.path).path)
+
+    def do_HEAD(self):
+        self.send_json(200, {})
+
+    def do_GET(self):
+        path = self.route()
+        if path == '/_ping':
+            body = b'OK'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/images/json':
+            with self.state['lock']:
+                self.send_json(200, list(self.state['images'].values()))
+        elif path == '/system/df':
+            with self.state['lock']:
+                images = list(self.state['images'].values())
+                self.send_json(200, {'LayersSize': sum(i['Size'] for i in images), 'Images': images,
+                                     'Containers': [], 'Volumes': []})
+        else:
+            match = re.match(r'^/images/(.+)/json$', path)
+            image = None
+            if match:
+                with self.state['lock']:
+                    name = match.group(1)
+                    image = self.state['images'].get(name) or next(
+                        (i for i in self.state['images'].values() if name in i['RepoTags']), None)
+            if image is None:
+                self.send_json(404, {'message': 'No such image'})
+            else:
+                self.send_json(200, image)
+
+    def do_POST(self):
+        path = self.route()
+        body = self.read_body()
+        query = parse_qs(urlparse(self.path).query)
+        if path == '/auth':
+            self.send_json(200, {'Status': 'Login Succeeded'})
+        elif path == '/build':
+            time.sleep(self.build_latency)
+            image_id = hashlib.sha256(body).hexdigest()[:12]
+            with self.state['lock']:
+                self.state['images'][image_id] = {'Id': 'sha256:' + image_id, 'RepoTags': query.get('t', []),
+                                                  'Size': len(body)}
+                self.state['builds'] += 1
+            self.start_chunked()
+            self.write_chunk(json.dumps({'stream': 'Step 1/1\n'}).encode('utf-8'))
+            self.write_chunk(json.dumps({'stream': 'Successfully built %s\n' % image_id}).encode('utf-8'))
+            self.end_chunked()
+        elif re.match(r'^/images/.+/push$', path):
+            time.sleep(self.push_latency)
+            with self.state['lock']:
+                self.state['pushes'] += 1
+                self.state['pushed_bytes'] += self.layer_size
+                self.state['pushed'].add(query.get('tag', ['latest'])[0])
+            layer = hashlib.sha256(self.path.encode('utf-8')).hexdigest()[:12]
+            self.start_chunked()
+            for line in ({'status': 'Pushing', 'id': layer,
+                          'progressDetail': {'current': self.layer_size, 'total': self.layer_size}},
+                         {'status': 'Pushed', 'id': layer},
+                         {'status': 'latest: digest: sha256:%s size: 1234' % layer}):
+                self.write_chunk(json.dumps(line).encode('utf-8') + b"\r\n")
+            self.end_chunked()
+        else:
+            self.send_json(404, {'message': 'not supported by the fake daemon'})
+
+    def do_DELETE(self):
+        match = re.match(r'^/images/(.+)$', self.route())
+        with self.state['lock']:
+            name = match.group(1) if match else None
+            image_id = next((k for k, i in self.state['images'].items() if name in i['RepoTags']), None)
+            if image_id is not None:
+                image = self.state['images'][image_id]
+                image['RepoTags'].remove(name)
+                if not image['RepoTags']:
+                    del self.state['images'][image_id]
+        if image_id is None:
+            self.send_json(404, {'message': 'No such image'})
+        else:
+            self.send_json(200, [{'Untagged': name}])
+
+
+def start_docker(build_latency=0, push_latency=0, layer_size=0):
+    state = {'lock': threading.Lock(), 'images': {}, 'builds': 0, 'pushes': 0, 'pushed_bytes': 0,
+             'pushed': set(), 'retags': 0}
+    server, url = start_server(DockerHandler, state=state, build_latency=build_latency,
+                               push_latency=push_latency, layer_size=layer_size)
+    return server, url, state
+
+
+# ECR, only the manifest calls: images the fake daemon pushed are in the registry
+
+
+class EcrHandler(FakeHandler):
+    docker_state = None
+    layer_size = 0
+
+    def manifest(self, tag):
+        image = next((i for i in self.docker_state['images'].values()
+                      if any(t.endswith(":" + tag) for t in i['RepoTags'])), None)
+        if image is None or tag not in self.docker_state['pushed']:
+            return None
+        return json.dumps({'schemaVersion': 2,
+                           'mediaType': 'application/vnd.docker.distribution.manifest.v2+json',
+                           'config': {'digest': image['Id'], 'size': 1024},
+                           'layers': [{'digest': image['Id'], 'size': self.layer_size}]})
+
+    def do_POST(self):
+        action = self.headers.get('X-Amz-Target', '').split('.')[-1]
+        request = json.loads(self.read_body().decode('utf-8') or '{}')
+        with self.docker_state['lock']:
+            if action == 'BatchGetImage':
+                tag = request['imageIds'][0]['imageTag']
+                manifest = self.manifest(tag)
+                images = [] if manifest is None else [{'imageId': {'imageTag': tag}, 'imageManifest': manifest}]
+                self.send_json(200, {'images': images, 'failures': []})
+            elif action == 'PutImage':
+                self.docker_state['pushed'].add(request['imageTag'])
+                self.docker_state['retags'] += 1
+                self.send_json(200, {'image': {'imageId': {'imageTag': request['imageTag']}}})
+            else:
+                self.send_json(400, {'__type': 'UnsupportedOperation', 'message': action})
+
+
+def start_ecr(docker_state, layer_size=0):
+    return start_server(EcrHandler, docker_state=docker_state, layer_size=layer_size)
+
+
+# Kubernetes API server
+
+RESOURCE_PATHS = [
+    (r'^/api/v1/namespaces/([^/]+)/(services|secrets|pods)(?:/([^/]+))?$', 'v1'),
+    (r'^/apis/extensions/v1beta1/namespaces/([^/]+)/(deployments|ingresses)(?:/([^/]+))?$', 'extensions/v1beta1'),
+    (r'^/apis/autoscaling/v1/namespaces/([^/]+)/(horizontalpodautoscalers)(?:/([^/]+))?$', 'autoscaling/v1'),
+]
+KINDS = {'services': 'Service', 'secrets': 'Secret', 'pods': 'Pod', 'deployments': 'Deployment',
+         'ingresses': 'Ingress', 'horizontalpodautoscalers': 'HorizontalPodAutoscaler'}
+
+
+def merge_patch(live, patch):
+    # strategic merge approximation: dicts merge, lists of named items merge by name
+    if isinstance(live, dict) and isinstance(patch, dict):
+        merged = dict(live)
+        for k, v in patch.items():
+            merged[k] = merge_patch(live.get(k), v) if v is not None else None
+        return dict((k, v) for k, v in merged.items() if v is not None)
+    if isinstance(live, list) and isinstance(patch, list) and \
+            all(isinstance(i, dict) and 'name' in i for i in live + patch):
+        by_name = dict((i['name'], i) for i in live)
+        for item in patch:
+            by_name[item['name']] = merge_patch(by_name.get(item['name']), item)
+        return list(by_name.values())
+    return copy.deepcopy(patch)
+
+
+class KubeState(object):
+
+    def __init__(self, ready_latency, latency):
+        self.lock = threading.Condition()
+        self.resources = {}
+        self.events = []
+        self.version = 0
+        self.ready_latency = ready_latency
+        self.latency = latency
+        self.requests = {}
+
+    def now(self):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    def put(self, plural, namespace, obj, event_type):
+        # callers hold self.lock
+        self.version += 1
+        obj.setdefault('metadata', {})['resourceVersion'] = str(self.version)
+        obj['metadata'].setdefault('namespace', namespace)
+        obj['metadata'].setdefault('uid', '%s-%s' % (plural, self.version))
+        obj['metadata'].setdefault('creationTimestamp', self.now())
+        # the API server always returns a status, the client requires an HPA's replica counts
+        if plural == 'deployments':
+            obj.setdefault('status', {})
+        elif plural == 'horizontalpodautoscalers':
+            obj.setdefault('status', {'currentReplicas': 0, 'desiredReplicas': 0})
+        key = (plural, namespace, obj['metadata']['name'])
+        if event_type == 'DELETED':
+            self.resources.pop(key, None)
+        else:
+            self.resources[key] = obj
+        self.events.append((self.version, plural, namespace, event_type, copy.deepcopy(obj)))
+        self.lock.notify_all()
+        if plural == 'deployments' and event_type != 'DELETED':
+            self.roll_pods(namespace, obj)
+        return obj
+
+    def roll_pods(self, namespace, deployment):
+        containers = deployment['spec']['template']['spec']['containers']
+        labels = deployment['spec']['template']['metadata']['labels']
+        image = containers[0]['image']
+        current = [o for (p, ns, n), o in self.resources.items()
+                   if p == 'pods' and ns == namespace and o['metadata'].get('labels') == labels]
+        if current and all(p['spec']['containers'][0]['image'] == image for p in current):
+            return
+        for pod in current:
+            self.put('pods', namespace, copy.deepcopy(pod), 'DELETED')
+        name = "%s-%s" % (deployment['metadata']['name'], self.version)
+        pod = {'apiVersion': 'v1', 'kind': 'Pod',
+               'metadata': {'name': name, 'labels': dict(labels)},
+               'spec': {'containers': [{'name': c['name'], 'image': c['image']} for c in containers]},
+               'status': {'phase': 'Pending', 'conditions': []}}
+        self.put('pods', namespace, pod, 'ADDED')
+        for step in (1, 2, 3):
+            timer = threading.Timer(self.ready_latency * step / 3.0, self.advance_pod, args=(namespace, name, step))
+            timer.daemon = True
+            timer.start()
+
+    def advance_pod(self, namespace, name, step):
+        with self.lock:
+            pod = self.resources.get(('pods', namespace, name))
+            if pod is None:
+                return
+            pod = copy.deepcopy(pod)
+            status = pod['status']
+            if step >= 1:
+                status['conditions'].append({'type': 'PodScheduled', 'status': 'True'})
+            if step >= 2:
+                status['containerStatuses'] = [{'name': c['name'], 'image': c['image'], 'imageID': 'sha256:fake',
+                                                'ready': step >= 3, 'restartCount': 0,
+                                                'state': {'running': {'startedAt': self.now()}}}
+                                               for c in pod['spec']['containers']]
+            if step >= 3:
+                status['phase'] = 'Running'
+                status['conditions'].append({'type': 'Ready', 'status': 'True'})
+            self.put('pods', namespace, pod, 'MODIFIED')
+            if step >= 3:
+                self.mark_available(namespace, pod)
+
+    def mark_available(self, namespace, pod):
+        # the deployment controller's view once the rollout's pod is ready
+        for (plural, ns, name), deployment in list(self.resources.items()):
+            if plural == 'deployments' and ns == namespace and \
+                    deployment['spec']['template']['metadata']['labels'] == pod['metadata']['labels']:
+                deployment = copy.deepcopy(deployment)
+                deployment['status'] = {'replicas': 1, 'updatedReplicas': 1, 'readyReplicas': 1,
+                                        'availableReplicas': 1}
+                self.put('deployments', namespace, deployment, 'MODIFIED')
+
+
+def label_match(obj, selector):
+    if not selector:
+        return True
+    labels = obj.get('metadata', {}).get('labels') or {}
+    match = re.match(r'^(\S+) in \((.*)\)$', selector)
+    if match:
+        return labels.get(match.group(1)) in match.group(2).split(',')
+    return all(labels.get(k) == v for k, v in (part.split('=', 1) for part in selector.split(',')))
+
+
+class KubeHandler(FakeHandler):
+    state = None
+
+    def resolve(self):
+        path = urlparse(self.path).path
+        for pattern, api_version in RESOURCE_PATHS:
+            match = re.match(pattern, path)
+            if match:
+                return match.group(1), match.group(2), match.group(3), api_version
+        return None
+
+    def count(self):
+        with self.state.lock:
+            self.state.requests[self.command] = self.state.requests.get(self.command, 0) + 1
+        time.sleep(self.state.latency)
+
+    def not_found(self, name):
+        self.send_json(404, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure',
+                             'message': '%s not found' % name, 'reason': 'NotFound', 'code': 404})
+
+    def do_GET(self):
+        self.count()
+        target = self.resolve()
+        if target is None:
+            self.not_found(self.path)
+            return
+        namespace, plural, name, api_version = target
+        query = dict((k, v[0]) for k, v in parse_qs(urlparse(self.path).query).items())
+        if name is not None:
+            with self.state.lock:
+                obj = self.state.resources.get((plural, namespace, name))
+            if obj is None:
+                self.not_found(name)
+            else:
+                self.send_json(200, obj)
+        elif query.get('watch') in ('true', 'True', '1'):
+            self.watch(namespace, plural, query)
+        else:
+            with self.state.lock:
+                items = [copy.deepcopy(o) for (p, ns, n), o in sorted(self.state.resources.items())
+                         if p == plural and ns == namespace and label_match(o, query.get('labelSelector'))]
+                version = str(self.state.version)
+            self.send_json(200, {'kind': KINDS[plural] + 'List', 'apiVersion': api_version,
+                                 'metadata': {'resourceVersion': version}, 'items': items})
+
+    def watch(self, namespace, plural, query):
+        since = int(query.get('resourceVersion') or 0)
+        deadline = time.time() + int(query.get('timeoutSeconds') or 60)
+        self.start_chunked()
+        try:
+            while True:
+                with self.state.lock:
+                    events = [e for e in self.state.events if e[0] > since and e[1] == plural and e[2] == namespace]
+                    if not events:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.state.lock.wait(min(remaining, 1))
+                        continue
+                for version, p, ns, event_type, obj in events:
+                    since = version
+                    if label_match(obj, query.get('labelSelector')):
+                        self.write_chunk(json.dumps({'type': event_type, 'object': obj}).encode('utf-8') + b"\n")
+            self.end_chunked()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        self.count()
+        namespace, plural, name, api_version = self.resolve()
+        obj = json.loads(self.read_body().decode('utf-8'))
+        with self.state.lock:
+            if (plural, namespace, obj['metadata']['name']) in self.state.resources:
+                self.send_json(409, {'kind': 'Status', 'code': 409, 'reason': 'AlreadyExists'})
+                return
+            obj = self.state.put(plural, namespace, obj, 'ADDED')
+            response = copy.deepcopy(obj)
+        self.send_json(201, response)
+
+    def do_PUT(self):
+        self.count()
+        namespace, plural, name, api_version = self.resolve()
+        obj = json.loads(self.read_body().decode('utf-8'))
+        with self.state.lock:
+            if (plural, namespace, name) not in self.state.resources:
+                self.not_found(name)
+                return
+            response = copy.deepcopy(self.state.put(plural, namespace, obj, 'MODIFIED'))
+        self.send_json(200, response)
+
+    def do_PATCH(self):
+        self.count()
+        namespace, plural, name, api_version = self.resolve()
+        patch = json.loads(self.read_body().decode('utf-8'))
+        with self.state.lock:
+            live = self.state.resources.get((plural, namespace, name))
+            if live is None:
+                self.not_found(name)
+                return
+            response = copy.deepcopy(self.state.put(plural, namespace, merge_patch(live, patch), 'MODIFIED'))
+        self.send_json(200, response)
+
+    def do_DELETE(self):
+        self.count()
+        namespace, plural, name, api_version = self.resolve()
+        self.read_body()
+        with self.state.lock:
+            obj = self.state.resources.get((plural, namespace, name))
+            if obj is None:
+                self.not_found(name)
+                return
+            self.state.put(plural, namespace, copy.deepcopy(obj), 'DELETED')
+        self.send_json(200, {'kind': 'Status', 'status': 'Success'})
+
+
+def start_kubernetes(ready_latency=0, latency=0):
+    state = KubeState(ready_latency, latency)
+    server, url = start_server(KubeHandler, state=state)
+    return server, url, state
+
+
+def write_kubeconfig(path, url):
+    with open(path, 'w') as f:
+        f.write("apiVersion: v1\n"
+                "kind: Config\n"
+                "clusters:\n"
+                "- name: fake\n"
+                "  cluster:\n"
+                "    server: %s\n"
+                "users:\n"
+                "- name: fake\n"
+                "  user:\n"
+                "    token: fake\n"
+                "contexts:\n"
+                "- name: fake\n"
+                "  context:\n"
+                "    cluster: fake\n"
+                "    user: fake\n"
+                "current-context: fake\n" % url)
+    return path
+
+
+# Callback receiver
+
+class CallbackHandler(FakeHandler):
+    received = None
+
+    def do_POST(self):
+        body = self.read_body()
+        with self.received['lock']:
+            self.received['calls'].append((time.time(), self.path, body))
+            self.received['lock'].notify_all()
+        self.send_json(200, {'ok': True})
+
+
+def start_callback_receiver():
+    received = {'lock': threading.Condition(), 'calls': []}
+    server, url = start_server(CallbackHandler, received=received)
+    return server, url, received
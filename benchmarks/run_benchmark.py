@@ -0,0 +1,233 @@
+"""
+End-to-end benchmark of a build job against the local fakes in benchmarks/fakes.py.
+
+    python benchmarks/run_benchmark.py --mode controller --jobs 20 --concurrency 10
+
+Reports jobs per minute, p50/p99 job latency and the process's peak RSS, and
+exits non-zero when --min-jobs-per-minute or --max-p99 are given and missed. In controller
+mode it also checks /jobs, /executors, /variables, /batch and /metrics once the jobs are done.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fakes  # noqa: E402
+
+REPO = "123456789012.dkr.ecr.us-west-2.amazonaws.com/nlu"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="KubBuilder end-to-end benchmark against local fakes")
+    parser.add_argument("--mode", choices=["service", "controller"], default="service",
+                        help="call kubbuilder_service.run directly or POST to the Flask app")
+    parser.add_argument("--jobs", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight (service mode)")
+    parser.add_argument("--archive-size", type=int, default=8 * 1024 * 1024, help="model blob bytes per archive")
+    parser.add_argument("--s3-latency", type=float, default=0.0, help="seconds added to every S3 request")
+    parser.add_argument("--build-latency", type=float, default=0.5)
+    parser.add_argument("--push-latency", type=float, default=0.5)
+    parser.add_argument("--k8s-latency", type=float, default=0.0, help="seconds added to every API server request")
+    parser.add_argument("--ready-latency", type=float, default=1.0, help="seconds from pod creation to Ready")
+    parser.add_argument("--same-archive", action="store_true",
+                        help="every job deploys the same archive (exercises the build cache)")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--min-jobs-per-minute", type=float)
+    parser.add_argument("--max-p99", type=float)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+
+def setup_environment(args, workdir):
+    archives = {}
+    shared = fakes.make_archive(args.archive_size) if args.same_archive else None
+    for i in range(args.jobs):
+        archives["executors/bench-%s/executor.zip" % i] = shared or fakes.make_archive(args.archive_size)
+
+    s3_server, s3_url = fakes.start_s3(archives, args.s3_latency)
+    docker_server, docker_url, docker_state = fakes.start_docker(
+        args.build_latency, args.push_latency, args.archive_size)
+    kube_server, kube_url, kube_state = fakes.start_kubernetes(args.ready_latency, args.k8s_latency)
+    ecr_server, ecr_url = fakes.start_ecr(docker_state, args.archive_size)
+
+    # constants reads the environment at import time
+    os.environ.update({
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "S3_ENDPOINT_URL": s3_url,
+        "ECR_ENDPOINT_URL": ecr_url,
+        "DOCKER_DAEMONS": docker_url.replace("http://", "tcp://"),
+        "DOCKER_REPO": REPO,
+        "KUBER_CONFIG": fakes.write_kubeconfig(os.path.join(workdir, "kubeconfig"), kube_url),
+        "DOMAIN": "bench.local",
+        "NLU_SECRET_NAME": "nlu-variables",
+        "BUILD_CACHE_FILE": os.path.join(workdir, "build_cache.json"),
+        "IMAGE_INDEX_FILE": os.path.join(workdir, "image_index.json"),
+        "CALLBACK_QUEUE_DIR": os.path.join(workdir, "callbacks"),
+        "INFORMER_SYNC_TIMEOUT": "5",
+        "READINESS_TIMEOUT": str(int(args.timeout))})
+    return {'archives': archives, 'docker': docker_state, 'kube': kube_state, 's3_url': s3_url}
+
+
+def seed_registry_token():
+    import constants
+    import operations.cloud_ops as cloud_ops
+    # the fake daemon accepts any login, so skip the ECR round trip
+    cloud_ops.tokens[(constants.CLOUD_USER, constants.DOCKER_REPO)] = ("bench", time.time() + 365 * 24 * 3600)
+
+
+def job_payload(i, callback_url=None):
+    payload = {
+        'executor_location': "https://s3.us-west-2.amazonaws.com/executors/bench-%s/executor.zip" % i,
+        'host_path': ["bench", str(i)]}
+    if callback_url is not None:
+        payload['callback_url'] = callback_url + "/%s" % i
+    return payload
+
+
+def run_service_mode(args):
+    import kubbuilder_service
+    latencies = []
+    failures = []
+
+    def one(i):
+        payload = job_payload(i)
+        start = time.time()
+        try:
+            result = kubbuilder_service.run(payload['executor_location'], payload['host_path'])
+            if not result['success']:
+                failures.append((i, result))
+        except Exception as e:
+            failures.append((i, repr(e)))
+        latencies.append(time.time() - start)
+
+    start = time.time()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(one, range(args.jobs)))
+    return time.time() - start, latencies, failures
+
+
+def run_controller_mode(args):
+    import controller
+    callback_server, callback_url, received = fakes.start_callback_receiver()
+    client = controller.app.test_client()
+    submitted = {}
+    job_ids = []
+
+    start = time.time()
+    for i in range(args.jobs):
+        submitted["/%s" % i] = time.time()
+        response = client.post("/", data=json.dumps(job_payload(i, callback_url)), content_type="application/json")
+        if response.status_code != 200:
+            raise Exception("job %s rejected: %s" % (i, response.data))
+        job_ids.append(json.loads(response.data.decode('utf-8'))['job_id'])
+
+    calls = wait_for_callbacks(received, args.jobs, start + args.timeout)
+    elapsed = time.time() - start
+
+    latencies = []
+    failures = []
+    for finished, path, body in calls:
+        latencies.append(finished - submitted[path])
+        result = json.loads(body.decode('utf-8'))
+        if not result.get('success'):
+            failures.append((path, result))
+    failures.extend((path, 'no callback') for path in submitted if path not in [c[1] for c in calls])
+    failures.extend(check_endpoints(args, client, job_ids, callback_url, received))
+    return elapsed, latencies, failures
+
+
+def wait_for_callbacks(received, count, deadline):
+    with received['lock']:
+        while len(received['calls']) < count and time.time() < deadline:
+            received['lock'].wait(1)
+        return list(received['calls'])
+
+
+def check_endpoints(args, client, job_ids, callback_url, received):
+    # the controller's other endpoints against the state the jobs left behind, not timed
+    failures = []
+
+    def expect_ok(name, response):
+        if response.status_code != 200:
+            failures.append((name, response.status_code, response.data[:500]))
+        return response
+
+    for job_id in job_ids:
+        expect_ok("/jobs/" + job_id, client.get("/jobs/" + job_id))
+    expect_ok("/executors", client.get("/executors"))
+    expect_ok("/variables", client.post("/variables", data=json.dumps({'BENCH_VARIABLE': 'bench'}),
+                                        content_type="application/json"))
+    expect_ok("/metrics", client.get("/metrics"))
+
+    # jobs 0 and 1 again: their images are cached, so the batch is a redeploy
+    batch = {'executors': [job_payload(i) for i in range(min(args.jobs, 2))],
+             'callback_url': callback_url + "/batch"}
+    if expect_ok("/batch", client.post("/batch", data=json.dumps(batch),
+                                       content_type="application/json")).status_code == 200:
+        calls = wait_for_callbacks(received, len(job_ids) + 1, time.time() + args.timeout)
+        results = [json.loads(body.decode('utf-8')) for _, path, body in calls if path == "/batch"]
+        if not results:
+            failures.append(("/batch", 'no callback'))
+        elif not results[0].get('success'):
+            failures.append(("/batch", results[0]))
+    return failures
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="kubbuilder-bench-")
+    env = setup_environment(args, workdir)
+    seed_registry_token()
+
+    if args.mode == "service":
+        elapsed, latencies, failures = run_service_mode(args)
+    else:
+        elapsed, latencies, failures = run_controller_mode(args)
+
+    report = {
+        'mode': args.mode,
+        'jobs': args.jobs,
+        'failed': len(failures),
+        'elapsed_seconds': round(elapsed, 3),
+        'jobs_per_minute': round(len(latencies) / elapsed * 60, 2) if elapsed else None,
+        'p50_seconds': percentile(latencies, 50),
+        'p99_seconds': percentile(latencies, 99),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+        'docker_builds': env['docker']['builds'],
+        'docker_pushes': env['docker']['pushes'],
+        'registry_retags': env['docker']['retags'],
+        'kube_requests': dict(env['kube'].requests)}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for k, v in report.items():
+            print("%-18s %s" % (k, v))
+        for failure in failures[:10]:
+            print("failure: %s" % (failure,))
+
+    ok = not failures
+    if args.min_jobs_per_minute is not None and (report['jobs_per_minute'] or 0) < args.min_jobs_per_minute:
+        ok = False
+    if args.max_p99 is not None and (report['p99_seconds'] is None or report['p99_seconds'] > args.max_p99):
+        ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import constants
+import metrics
+import json
+import os
+import random
+import requests
+import threading
+import time
+import uuid
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+from coralogger import get_default_logger, RATE_LIMITED
+
+log = get_default_logger()
+
+# Deliveries waiting to be sent, by id. Each one is also a file in CALLBACK_QUEUE_DIR
+# until it's delivered, so results survive a restart.
+deliveries_lock = threading.Condition()
+deliveries = {}
+in_flight = set()
+workers = []
+
+sessions_lock = threading.Lock()
+sessions = {}
+
+RETRIED_STATUS_CODES = [408, 425, 429]
+
+
+def enqueue(request_id, url, result):
+    """
+    Queues the job result for POSTing to url and returns right away
+    """
+    delivery = {'id': str(uuid.uuid4()),
+                'request_id': request_id,
+                'url': url,
+                'body': json.dumps(result),
+                'attempts': 0,
+                'created': time.time(),
+                'next_attempt': time.time()}
+    save_delivery(delivery)
+    with deliveries_lock:
+        deliveries[delivery['id']] = delivery
+        deliveries_lock.notify()
+    start_workers()
+    return delivery['id']
+
+
+def start_workers():
+    with deliveries_lock:
+        if workers:
+            return
+        for delivery in load_deliveries():
+            deliveries[delivery['id']] = delivery
+        for i in range(constants.CALLBACK_WORKERS):
+            worker = threading.Thread(target=run_worker, daemon=True)
+            worker.start()
+            workers.append(worker)
+
+
+def delivery_file(delivery_id, failed=False):
+    directory = os.path.join(constants.CALLBACK_QUEUE_DIR, "failed") if failed else constants.CALLBACK_QUEUE_DIR
+    return os.path.join(directory, delivery_id + ".json")
+
+
+def save_delivery(delivery, failed=False):
+    path = delivery_file(delivery['id'], failed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = path + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(delivery, f)
+    os.replace(tmp_file, path)
+
+
+def remove_delivery(delivery_id):
+    try:
+        os.remove(delivery_file(delivery_id))
+    except FileNotFoundError:
+        pass
+
+
+def load_deliveries():
+    if not os.path.isdir(constants.CALLBACK_QUEUE_DIR):
+        return []
+    loaded = []
+    for name in os.listdir(constants.CALLBACK_QUEUE_DIR):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(constants.CALLBACK_QUEUE_DIR, name), 'r') as f:
+                loaded.append(json.load(f))
+        except ValueError as e:
+            log.error("Callback delivery %s is corrupted, skipping. Exception: %s", name, e)
+    if loaded:
+        log.debug("Loaded %s pending callback deliveries", len(loaded))
+    return loaded
+
+
+def host_of(url):
+    parts = urlsplit(url)
+    return parts.scheme + "://" + parts.netloc
+
+
+def get_session(host):
+    # one pooled session per receiver, connections are kept alive between deliveries
+    with sessions_lock:
+        session = sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            session.mount(host, HTTPAdapter(pool_connections=1, pool_maxsize=constants.CALLBACK_WORKERS))
+            session.headers['Content-Type'] = "application/json"
+            sessions[host] = session
+        return session
+
+
+def backoff(attempts):
+    # exponential backoff with full jitter
+    ceiling = min(constants.CALLBACK_BACKOFF_MAX, constants.CALLBACK_BACKOFF_BASE * 2 ** (attempts - 1))
+    return random.uniform(0, ceiling)
+
+
+def take_batch():
+    """
+    Blocks until deliveries are due and returns up to CALLBACK_BATCH_SIZE of them,
+    all for the receiver whose delivery has waited the longest
+    """
+    with deliveries_lock:
+        while True:
+            now = time.time()
+            waiting = [d for d in deliveries.values() if d['id'] not in in_flight]
+            due = [d for d in waiting if d['next_attempt'] <= now]
+            if due:
+                host = host_of(min(due, key=lambda d: d['next_attempt'])['url'])
+                batch = sorted((d for d in due if host_of(d['url']) == host),
+                               key=lambda d: d['next_attempt'])[:constants.CALLBACK_BATCH_SIZE]
+                in_flight.update(d['id'] for d in batch)
+                return host, batch
+            next_attempt = min((d['next_attempt'] for d in waiting), default=None)
+            deliveries_lock.wait(None if next_attempt is None else next_attempt - now)
+
+
+def run_worker():
+    while True:
+        host, batch = take_batch()
+        try:
+            deliver_batch(host, batch)
+        except Exception as e:
+            log.error("Callback delivery to %s failed unexpectedly. Exception: %s", host, e)
+        finally:
+            with deliveries_lock:
+                in_flight.difference_update(d['id'] for d in batch)
+                deliveries_lock.notify_all()
+
+
+def deliver_batch(host, batch):
+    # the batch goes out back to back over the receiver's pooled connection; coalesced
+    # jobs that report the same result to the same url are posted once
+    session = get_session(host)
+    posts = {}
+    for delivery in batch:
+        posts.setdefault((delivery['url'], delivery['body']), []).append(delivery)
+
+    for (url, body), same in posts.items():
+        outcome = post(session, url, body, [d['request_id'] for d in same])
+        for delivery in same:
+            finish_attempt(delivery, outcome)
+
+
+def post(session, url, body, request_ids):
+    start = time.time()
+    try:
+        response = session.post(url, data=body,
+                                timeout=(constants.CALLBACK_CONNECT_TIMEOUT, constants.CALLBACK_READ_TIMEOUT))
+        log.debug("Callback for %s to %s: status code %s, response: %s",
+                  request_ids, url, response.status_code, response.text)
+        if response.status_code < 400:
+            outcome = 'delivered'
+        elif response.status_code >= 500 or response.status_code in RETRIED_STATUS_CODES:
+            outcome = 'retry'
+        else:
+            outcome = 'rejected'
+    except requests.RequestException as e:
+        log.debug("Callback for %s to %s failed. Exception: %s", request_ids, url, e, extra=RATE_LIMITED)
+        outcome = 'retry'
+    metrics.observe('kubbuilder_callback_duration_seconds', time.time() - start, outcome=outcome)
+    return outcome
+
+
+def finish_attempt(delivery, outcome):
+    delivery['attempts'] += 1
+    if outcome == 'retry' and delivery['attempts'] < constants.CALLBACK_MAX_ATTEMPTS:
+        delivery['next_attempt'] = time.time() + backoff(delivery['attempts'])
+        save_delivery(delivery)
+        metrics.inc('kubbuilder_callbacks_total', outcome='retried')
+        return
+
+    with deliveries_lock:
+        deliveries.pop(delivery['id'], None)
+    if outcome == 'delivered':
+        metrics.inc('kubbuilder_callbacks_total', outcome='delivered')
+        metrics.observe('kubbuilder_callback_latency_seconds', time.time() - delivery['created'])
+    else:
+        # kept under failed/ for inspection or a manual replay
+        log.error("Callback for %s to %s given up after %s attempts",
+                  delivery['request_id'], delivery['url'], delivery['attempts'])
+        save_delivery(delivery, failed=True)
+        metrics.inc('kubbuilder_callbacks_total', outcome='failed')
+    remove_delivery(delivery['id'])
+
+
+def export_metrics():
+    with deliveries_lock:
+        metrics.set_gauge('kubbuilder_callback_queue_depth', len(deliveries))
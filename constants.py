@@ -1,6 +1,10 @@
 import os
 
 LOCAL_PATH = '/tmp/nlu'
+# Archives are downloaded to DOWNLOAD_PATH/<tag> and synced into the persistent LOCAL_PATH/<tag>
+DOWNLOAD_PATH = os.environ.get("DOWNLOAD_PATH", "/tmp/nlu-downloads")
+WORKSPACE_MANIFEST_DIR = os.environ.get("WORKSPACE_MANIFEST_DIR", "/tmp/nlu-cache/workspaces")
+WORKSPACE_MAX_BYTES = int(os.environ.get("WORKSPACE_MAX_BYTES", 20 * 1024 ** 3))
 CLOUD_USER = os.environ.get("AWS_ACCESS_KEY_ID")
 CLOUD_PASSWORD = os.environ.get("AWS_SECRET_ACCESS_KEY")
 DOCKER_REPO = os.environ.get("DOCKER_REPO")
@@ -10,6 +14,100 @@ KUBER_SERVICE_DOMAIN = os.environ.get("KUBER_SERVICE_DOMAIN")
 NLU_SECRET_NAME = os.environ.get("NLU_SECRET_NAME")
 NAMESPACE = "nlu"
 INCLUSTER = os.environ.get("INCLUSTER")
+CLOUD_REGION = os.environ.get("CLOUD_REGION", "us-west-2")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+ECR_ENDPOINT_URL = os.environ.get("ECR_ENDPOINT_URL")
+REGISTRY_TOKEN_REFRESH_MARGIN = int(os.environ.get("REGISTRY_TOKEN_REFRESH_MARGIN", 30 * 60))
+
+# S3 ranged download
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", 16 * 1024 * 1024))
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 8))
+DOWNLOAD_VERIFY_CHECKSUM = os.environ.get("DOWNLOAD_VERIFY_CHECKSUM", "true") == "true"
+
+# Docker build daemons, comma separated; builds go to the least loaded healthy one
+DOCKER_DAEMONS = os.environ.get("DOCKER_DAEMONS", "tcp://127.0.0.1:2375").split(",")
+DOCKER_HEALTHCHECK_INTERVAL = int(os.environ.get("DOCKER_HEALTHCHECK_INTERVAL", 30))
+
+# Image GC: every IMAGE_GC_INTERVAL seconds, daemons whose layers take more than the high-water
+# mark lose their least recently used executor images until they're under the low-water mark
+IMAGE_GC_INTERVAL = int(os.environ.get("IMAGE_GC_INTERVAL", 300))
+IMAGE_GC_HIGH_WATER_BYTES = int(os.environ.get("IMAGE_GC_HIGH_WATER_BYTES", 50 * 1024 ** 3))
+IMAGE_GC_LOW_WATER_BYTES = int(os.environ.get("IMAGE_GC_LOW_WATER_BYTES", 40 * 1024 ** 3))
+IMAGE_GC_MIN_AGE = int(os.environ.get("IMAGE_GC_MIN_AGE", 3600))
+
+# Pipeline: worker threads per stage of kubbuilder_service.STAGES
+PIPELINE_WORKERS = {
+    'download': int(os.environ.get("PIPELINE_DOWNLOAD_WORKERS", 4)),
+    'build': int(os.environ.get("PIPELINE_BUILD_WORKERS", 2)),
+    'push': int(os.environ.get("PIPELINE_PUSH_WORKERS", 2)),
+    'deploy': int(os.environ.get("PIPELINE_DEPLOY_WORKERS", 16))}
+
+# Page size of /executors
+EXECUTORS_PAGE_SIZE = int(os.environ.get("EXECUTORS_PAGE_SIZE", 100))
+EXECUTORS_MAX_PAGE_SIZE = int(os.environ.get("EXECUTORS_MAX_PAGE_SIZE", 1000))
+
+# Finished jobs kept for /jobs/<request_id>
+JOB_HISTORY_SIZE = int(os.environ.get("JOB_HISTORY_SIZE", 1000))
+
+# Job result callbacks: queued on disk and retried with exponential backoff
+CALLBACK_QUEUE_DIR = os.environ.get("CALLBACK_QUEUE_DIR", "/tmp/nlu-cache/callbacks/")
+CALLBACK_WORKERS = int(os.environ.get("CALLBACK_WORKERS", 4))
+CALLBACK_BATCH_SIZE = int(os.environ.get("CALLBACK_BATCH_SIZE", 20))
+CALLBACK_MAX_ATTEMPTS = int(os.environ.get("CALLBACK_MAX_ATTEMPTS", 12))
+CALLBACK_BACKOFF_BASE = float(os.environ.get("CALLBACK_BACKOFF_BASE", 1))
+CALLBACK_BACKOFF_MAX = float(os.environ.get("CALLBACK_BACKOFF_MAX", 300))
+CALLBACK_CONNECT_TIMEOUT = float(os.environ.get("CALLBACK_CONNECT_TIMEOUT", 5))
+CALLBACK_READ_TIMEOUT = float(os.environ.get("CALLBACK_READ_TIMEOUT", 30))
+
+# Histogram buckets (seconds) for /metrics
+METRICS_BUCKETS = [0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200]
+
+# Archive extraction: members are spread over UNZIP_WORKERS threads once the archive
+# holds at least UNZIP_PARALLEL_MIN_SIZE compressed bytes
+UNZIP_WORKERS = int(os.environ.get("UNZIP_WORKERS", os.cpu_count() or 1))
+UNZIP_CHUNK_SIZE = int(os.environ.get("UNZIP_CHUNK_SIZE", 1024 * 1024))
+UNZIP_PARALLEL_MIN_SIZE = int(os.environ.get("UNZIP_PARALLEL_MIN_SIZE", 64 * 1024 * 1024))
+
+# Build context: "extract" unpacks the archive to LOCAL_PATH, "stream" pipes zip entries to the daemon as a tar
+BUILD_CONTEXT_MODE = os.environ.get("BUILD_CONTEXT_MODE", "extract")
+DOCKERFILE_NAME = "Dockerfile.nlu"
+
+# Dependency layer cache: prebuild "<base> + pip install requirements" once per manifest hash
+DEPS_LAYER_CACHE = os.environ.get("DEPS_LAYER_CACHE", "false") == "true"
+REQUIREMENTS_FILE = "requirements.txt"
+
+# Build cache: archive digest -> image tag already pushed to DOCKER_REPO
+BUILD_CACHE_FILE = os.environ.get("BUILD_CACHE_FILE", "/tmp/nlu-cache/build_cache.json")
+BUILD_CACHE_MAX_ENTRIES = int(os.environ.get("BUILD_CACHE_MAX_ENTRIES", 500))
+BUILD_CACHE_TTL = int(os.environ.get("BUILD_CACHE_TTL", 7 * 24 * 3600))
+# Image id -> first time_tag pushed with it, to retag instead of pushing an identical image again
+IMAGE_INDEX_FILE = os.environ.get("IMAGE_INDEX_FILE", "/tmp/nlu-cache/image_index.json")
+
+# Watch-fed cache of the namespace's services, deployments, hpas, ingresses and secrets
+INFORMER_SYNC_TIMEOUT = int(os.environ.get("INFORMER_SYNC_TIMEOUT", 30))
+INFORMER_WATCH_TIMEOUT = int(os.environ.get("INFORMER_WATCH_TIMEOUT", 300))
+INFORMER_RETRY_DELAY = int(os.environ.get("INFORMER_RETRY_DELAY", 5))
+
+# Desired fields the reconciler never patches, per kind: replicas belong to the HPA once it exists
+RECONCILE_IGNORED_FIELDS = {'deployment': [['spec', 'replicas']]}
+
+# Rollout readiness
+READINESS_TIMEOUT = int(os.environ.get("READINESS_TIMEOUT", 600))
+READINESS_MIN_REPLICAS = int(os.environ.get("READINESS_MIN_REPLICAS", 1))
+# Delay before relisting after a failed pod list or watch, doubled on each consecutive failure
+READINESS_RETRY_DELAY = float(os.environ.get("READINESS_RETRY_DELAY", 1))
+READINESS_RETRY_MAX_DELAY = float(os.environ.get("READINESS_RETRY_MAX_DELAY", 30))
+READINESS_FAILURE_REASONS = ["CrashLoopBackOff", "ImagePullBackOff", "ErrImagePull",
+                             "InvalidImageName", "CreateContainerConfigError"]
+
+# Pre-pull: right after a push a short-lived DaemonSet pulls the new image on the nodes matching
+# PREPULL_NODE_SELECTOR ("key=value,key=value") while the deploy runs. It only runs with a selector:
+# the executors can schedule on any node and warming all of them costs a multi-GB pull each.
+PREPULL_ENABLED = os.environ.get("PREPULL_ENABLED", "false")
+PREPULL_TIMEOUT = int(os.environ.get("PREPULL_TIMEOUT", 600))
+PREPULL_STATUS_INTERVAL = int(os.environ.get("PREPULL_STATUS_INTERVAL", 10))
+PREPULL_NODE_SELECTOR = os.environ.get("PREPULL_NODE_SELECTOR", "")
+PREPULL_PAUSE_IMAGE = os.environ.get("PREPULL_PAUSE_IMAGE", "k8s.gcr.io/pause:3.1")
 
 # Logs
 CORALOGIX_ENABLED = os.environ.get("CORALOGIX_ENABLED")
@@ -34,9 +132,39 @@ LOGGING_SEVERITY = "DEBUG"
 LOG_DEFAULT_FORMAT = '[{levelname} {asctime} {module}:{funcName}:{lineno}] {message}'
 LOG_DEFAULT_DATE_FORMAT = '%y-%m-%d %H:%M:%S'
 
+# Log records are queued and written by a background thread in batches
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", 200))
+LOG_STOP_TIMEOUT = float(os.environ.get("LOG_STOP_TIMEOUT", 5))
+# At most LOG_RATE_LIMIT records per rate limited call site every LOG_RATE_WINDOW seconds, 0 disables
+LOG_RATE_LIMIT = int(os.environ.get("LOG_RATE_LIMIT", 20))
+LOG_RATE_WINDOW = float(os.environ.get("LOG_RATE_WINDOW", 10))
+
+# Tracing: per-function spans of a job written as JSON lines
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED")
+TRACE_LOGGER_NAME = "KubBuilder Trace"
+TRACE_FILE_PREFIX = "kubbuilder.trace.jsonl"
+TRACE_FILE_ROOT = "./logs/"
+TRACE_FILE_MAX_BYTES = int(os.environ.get("TRACE_FILE_MAX_BYTES", 50 * 1024 * 1024))
+TRACE_FILE_NUM_BACKUPS = int(os.environ.get("TRACE_FILE_NUM_BACKUPS", 3))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.01))
+
 # memmory allocation
 
 MALLOCATION_COEFICIENT = float(0.00004)
 MALLOCATION_CONSTANT = float(77.4)
 MALLOCATION_ALLOWANCE = float(1.10)
 MALLOCATION_FILES = ["intent_train.csv", "entity.csv"]
+
+# Sizing from observed usage: peaks sampled from the metrics API are fitted against archive
+# features; the formula above is used until SIZING_MIN_OBSERVATIONS deployments were measured
+SIZING_DB_FILE = os.environ.get("SIZING_DB_FILE", "/tmp/nlu-cache/sizing.db")
+SIZING_SAMPLE_INTERVAL = int(os.environ.get("SIZING_SAMPLE_INTERVAL", 60))
+SIZING_MIN_OBSERVATIONS = int(os.environ.get("SIZING_MIN_OBSERVATIONS", 10))
+SIZING_HISTORY_SIZE = int(os.environ.get("SIZING_HISTORY_SIZE", 500))
+SIZING_PERCENTILE = float(os.environ.get("SIZING_PERCENTILE", 95))
+SIZING_MEMORY_HEADROOM = float(os.environ.get("SIZING_MEMORY_HEADROOM", 1.10))
+SIZING_LIMIT_FACTOR = float(os.environ.get("SIZING_LIMIT_FACTOR", 1.0))
+SIZING_MIN_MEMORY = float(os.environ.get("SIZING_MIN_MEMORY", 64))
+SIZING_MIN_CPU = float(os.environ.get("SIZING_MIN_CPU", 20))
+SIZING_DEFAULT_CPU = "80m"
@@ -2,33 +2,34 @@
 """
 @author: sergii shapovalenko
 """
-from flask import Flask, jsonify, request
-from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, jsonify, request
+import callbacks
 import kubbuilder_service
-import requests
+import pipeline
+import metrics
 from coralogger import get_default_logger
 import uuid
 import traceback
-import json
 
 
 app = Flask(__name__)
 
 log = get_default_logger()
 
-executor = ThreadPoolExecutor(2)
-
 
 @app.route("/", methods=["POST"])
 def index():
     try:
         contents = request.get_json()
         contents['request_id'] = str(uuid.uuid4())
-        log.debug("index request: %s" % contents)
+        log.debug("index request: %s", contents)
 
-        executor.submit(background, contents)
+        job = kubbuilder_service.create_job(contents['executor_location'], contents['host_path'])
+        job['request_id'] = contents['request_id']
+        job['profile'] = bool(contents.get('profile'))
+        job = pipeline.submit(job, lambda finished: background(contents, finished))
 
-        response = {'success': True}
+        response = {'success': True, 'job_id': job['request_id']}
         log.debug("index response for: %s, status code: %s, response: %s", contents['request_id'], 200, response)
         return jsonify(response), 200
     except:
@@ -37,20 +38,66 @@ def index():
         return jsonify(error_json), 500
 
 
-def background(contents):
+def background(contents, job):
     try:
-        log.debug("Start building! %s", contents['request_id'])
-        response_data = json.dumps(kubbuilder_service.run(contents['executor_location'], contents['host_path']))
-        log.debug("Sending: request %s, %s to: %s", contents['request_id'], response_data, contents['callback_url'])
+        if 'error' in job:
+            log.error("background error for: %s, error_json: %s", contents['request_id'], str({'error': job['error']}))
+            return
+        log.debug("Queueing callback: request %s, %s to: %s", contents['request_id'], job['result'], contents['callback_url'])
+        # delivered with retries by callbacks' workers, the stage worker doesn't wait for the receiver
+        callbacks.enqueue(contents['request_id'], contents['callback_url'], job['result'])
+    except:
+        log.error("background error for: %s, error_json: %s", contents['request_id'], str({'error': traceback.format_exc()}))
 
-        response = requests.post(
-            url=contents['callback_url'],
-            json=response_data)
 
-        log.debug("request_id: %s, Status code: %s, response: %s", contents['request_id'], response.status_code, response.text)
-        log.debug("request_id: %s completed successfully", contents['request_id'])
+@app.route("/batch", methods=["POST"])
+def batch():
+    try:
+        contents = request.get_json()
+        contents['request_id'] = str(uuid.uuid4())
+        log.debug("batch request: %s", contents)
+
+        items = contents['executors']
+        jobs = []
+        for item in items:
+            item['request_id'] = str(uuid.uuid4())
+            job = kubbuilder_service.create_job(item['executor_location'], item['host_path'])
+            job['request_id'] = item['request_id']
+            job['profile'] = bool(contents.get('profile'))
+            jobs.append(job)
+
+        served = pipeline.submit_batch(
+            jobs,
+            [lambda finished, item=item: background(item, finished) if item.get('callback_url') else None
+             for item in items],
+            lambda finished_jobs: batch_background(contents, items, finished_jobs))
+
+        response = {'success': True, 'batch_id': contents['request_id'], 'job_ids': [job['request_id'] for job in served]}
+        log.debug("batch response for: %s, status code: %s, response: %s", contents['request_id'], 200, response)
+        return jsonify(response), 200
     except:
-        log.error("background error for: %s, error_json: %s", contents['request_id'], str({'error': traceback.format_exc()}))
+        error_json = {'error': traceback.format_exc()}
+        log.error("batch response, status code: %s, response: %s", 500, str(error_json))
+        return jsonify(error_json), 500
+
+
+def batch_background(contents, items, jobs):
+    # one aggregated result for the batch's callback_url, items with their own got theirs already
+    if not contents.get('callback_url'):
+        return
+    try:
+        results = []
+        for item, job in zip(items, jobs):
+            if 'error' in job:
+                result = {'success': False, 'error': job['error']}
+            else:
+                result = job.get('result') or {'success': False}
+            results.append(dict(result, host_path=item['host_path'], job_id=job.get('request_id')))
+        callbacks.enqueue(contents['request_id'], contents['callback_url'],
+                          {'success': all(r['success'] for r in results), 'results': results})
+    except:
+        log.error("batch background error for: %s, error_json: %s", contents['request_id'],
+                  str({'error': traceback.format_exc()}))
 
 
 @app.route("/variables", methods=["POST"])
@@ -66,6 +113,55 @@ def variables():
         return error_json, 500
 
 
+@app.route("/cache/invalidate", methods=["POST"])
+def cache_invalidate():
+    try:
+        contents = request.get_json(silent=True) or {}
+        removed = kubbuilder_service.invalidate_build_cache(contents.get('host_path'))
+        return jsonify({'success': True, 'removed': removed}), 200
+
+    except:
+        error_json = {'error': traceback.format_exc()}
+        log.error("Status code: %s, response: %s", 500, error_json)
+        return jsonify(error_json), 500
+
+
+@app.route("/jobs/<request_id>", methods=["GET"])
+def job_status(request_id):
+    job = pipeline.get_job(request_id)
+    if job is None:
+        return jsonify({'error': "job %s not found" % request_id}), 404
+    return jsonify(job), 200
+
+
+@app.route("/executors", methods=["GET"])
+def executors():
+    try:
+        offset = request.args.get('offset', '0')
+        limit = request.args.get('limit')
+        if not offset.isdigit() or (limit is not None and (not limit.isdigit() or int(limit) < 1)):
+            return jsonify({'error': "offset must be an integer >= 0 and limit an integer >= 1"}), 400
+
+        response = kubbuilder_service.executors_status(
+            prefix=request.args.get('prefix'),
+            status=request.args.get('status'),
+            offset=int(offset),
+            limit=int(limit) if limit is not None else None)
+        return jsonify(response), 200
+
+    except:
+        error_json = {'error': traceback.format_exc()}
+        log.error("Status code: %s, response: %s", 500, error_json)
+        return jsonify(error_json), 500
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    pipeline.export_metrics()
+    callbacks.export_metrics()
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/healthcheck", methods=["GET"])
 def healthcheck():
     return "ok"
@@ -1,7 +1,12 @@
+import atexit
 import constants as config
+import metrics
 import os
+import queue
+import threading
+import time
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, TimedRotatingFileHandler
 
 from coralogix.coralogix_logger import CoralogixLogger
 
@@ -39,11 +44,7 @@ def create_coralogix_logger(logger, app):
     coralogix_logger = CoralogixLogger.get_logger(config.CORALOGIX_SUB_SYSTEM)
     coralogix_logger.setLevel(config.LOGGING_SEVERITY)
 
-    logger.addHandler(coralogix_logger)
-    logger.setLevel(config.LOGGING_SEVERITY)
-
-    app.logger.addHandler(coralogix_logger)
-    app.logger.setLevel(config.LOGGING_SEVERITY)
+    add_queue_handler(logger, app, coralogix_logger)
 
 
 def create_file_logger(logger, app):
@@ -57,10 +58,10 @@ def create_file_logger(logger, app):
     os.makedirs(config.LOG_FILE_ROOT, exist_ok=True)
 
     # add a timed rotating handler
-    handler = TimedRotatingFileHandler(log_path,
-                                       when=config.LOG_ROTATE_WHEN,
-                                       interval=config.LOG_ROTATE_INTERVAL,
-                                       backupCount=config.LOG_FILE_NUM_BACKUPS)
+    handler = BatchedTimedRotatingFileHandler(log_path,
+                                              when=config.LOG_ROTATE_WHEN,
+                                              interval=config.LOG_ROTATE_INTERVAL,
+                                              backupCount=config.LOG_FILE_NUM_BACKUPS)
 
     handler.setLevel(config.LOGGING_SEVERITY)
 
@@ -68,13 +69,150 @@ def create_file_logger(logger, app):
                                            datefmt=config.LOG_DEFAULT_DATE_FORMAT,
                                            style="{"))
 
+    add_queue_handler(logger, app, handler)
+
+
+def add_queue_handler(logger, app, handler):
+    """
+    Puts the handler behind a bounded queue drained by a background thread,
+    so the request path only pays for enqueueing the record.
+    """
+
+    records = queue.Queue(config.LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter(config.LOG_RATE_LIMIT, config.LOG_RATE_WINDOW))
+    listener = QueueListenerThread(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
     # Add handlers to both the default and Flask handlers
-    logger.addHandler(handler)
+    logger.addHandler(queue_handler)
     logger.setLevel(config.LOGGING_SEVERITY)
-    app.logger.addHandler(handler)
+    app.logger.addHandler(queue_handler)
     app.logger.setLevel(config.LOGGING_SEVERITY)
 
 
+# Passed as extra= by call sites that can log in a tight loop (watch relists, retries):
+# only their records go through the RateLimitFilter
+RATE_LIMITED = {'rate_limited': True}
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Enqueues records and drops them when the queue is full
+    """
+
+    def prepare(self, record):
+        # the message is merged on the calling thread, args like job dicts may change
+        # before the listener gets to the record; the traceback only exists until then too
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('kubbuilder_log_records_dropped_total', reason='queue_full')
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `limit` records per call site in every `window` seconds, for
+    the call sites that opted in with extra=RATE_LIMITED
+    """
+
+    def __init__(self, limit, window):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.sites = {}
+
+    def filter(self, record):
+        if not getattr(record, 'rate_limited', False) or self.limit <= 0:
+            return True
+
+        key = (record.name, record.pathname, record.lineno)
+        now = time.time()
+        with self.lock:
+            started, count = self.sites.get(key, (now, 0))
+            if now - started >= self.window:
+                started, count = now, 0
+            self.sites[key] = (started, count + 1)
+
+        if count < self.limit:
+            return True
+        metrics.inc('kubbuilder_log_records_dropped_total', reason='rate_limited')
+        return False
+
+
+class QueueListenerThread(threading.Thread):
+    """
+    Drains the log queue in batches of up to LOG_BATCH_SIZE records and flushes
+    the handler once per batch
+    """
+
+    def __init__(self, records, handler):
+        super().__init__(daemon=True)
+        self.records = records
+        self.handler = handler
+
+    def run(self):
+        while True:
+            batch = [self.records.get()]
+            while len(batch) < config.LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = None in batch
+            for record in batch:
+                if record is None:
+                    continue
+                try:
+                    if record.levelno >= self.handler.level:
+                        self.handler.handle(record)
+                except Exception:
+                    self.handler.handleError(record)
+
+            try:
+                if isinstance(self.handler, BatchedTimedRotatingFileHandler):
+                    self.handler.flush_batch()
+                else:
+                    self.handler.flush()
+            except Exception:
+                pass
+
+            if stopping:
+                return
+
+    def stop(self):
+        # writes out whatever is still queued when the process exits
+        try:
+            self.records.put(None, timeout=config.LOG_STOP_TIMEOUT)
+        except queue.Full:
+            return
+        self.join(config.LOG_STOP_TIMEOUT)
+
+
+class BatchedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    Leaves flushing to the listener, which calls flush_batch after each batch
+    instead of flushing the file after every record
+    """
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
 def get_default_logger():
     """
     Returns the default logger
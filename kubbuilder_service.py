@@ -3,163 +3,462 @@ import base64
 import operations.cloud_ops as cloud_ops
 import operations.simple_ops as simple_ops
 import operations.docker_ops as docker_ops
+import operations.image_gc_ops as image_gc_ops
 import operations.kuber_ops as kuber_ops
+import operations.cache_ops as cache_ops
+import operations.informer_ops as informer_ops
+import operations.prepull_ops as prepull_ops
+import operations.reconcile_ops as reconcile_ops
+import operations.sizing_ops as sizing_ops
+import operations.workspace_ops as workspace_ops
+import metrics
+import threading
 import time
-import socket
+import os
+import hashlib
+import json
+import traceback
 
-from coralogger import get_default_logger
+from coralogger import get_default_logger, RATE_LIMITED
 
 log = get_default_logger()
 
+connect_lock = threading.Lock()
+connection = {'connected': False}
+
+# /variables updates waiting for the secret writer, merged into a single patch
+secret_lock = threading.Lock()
+secret_write_lock = threading.Lock()
+secret_batch = {}
+
 
 def run(executor_location, host_path):
-    tag = ('-'.join(host_path)).lower()
-    path = constants.LOCAL_PATH + "/" + tag
+    job = create_job(executor_location, host_path)
+    for name, stage in STAGES:
+        stage(job)
+    return job['result']
+
+
+def create_job(executor_location, host_path):
+    return {
+        'executor_location': executor_location,
+        'host_path': host_path,
+        'tag': ('-'.join(host_path)).lower()}
+
+
+def stage_download(job):
+    with metrics.timer(job, 'download'):
+        job['archive_path'] = download(job['executor_location'], job['tag'])
+    metrics.inc('kubbuilder_downloaded_bytes_total', os.path.getsize(job['archive_path']))
+    job['features'] = get_archive_features(job['archive_path'], constants.MALLOCATION_FILES)
+    job['sizing'] = sizing_ops.recommend(constants.SIZING_DB_FILE, job['features'])
+
+
+def stage_build(job):
+    build_image(job)
 
-    download_unzip(executor_location, tag)
-    mem_allocation = get_memory_reservation(path, constants.MALLOCATION_FILES)
 
-    time_tag = build_send_registry(tag)
+def stage_push(job):
+    push_built_image(job)
+    # a cached image was pushed and warmed by the job that built it
+    if constants.PREPULL_ENABLED == 'true' and prepull_ops.node_selector() and not job.get('cached'):
+        connect_kubernetes()
+        job['prepull'] = prepull_ops.start_prepull(
+            job['tag'], constants.DOCKER_REPO + ":" + job['time_tag'], constants.NAMESPACE)
 
-    deploy_to_kubernetes(tag, time_tag, mem_allocation)
 
-    result = executor_status_running(tag, constants.NAMESPACE)
+def stage_deploy(job):
+    tag = job['tag']
+    with metrics.timer(job, 'deploy'):
+        reconcile_stats = deploy_to_kubernetes(tag, job['time_tag'], job['sizing'])
 
-    return {'success': result, 'response': str(tag + "." + constants.DOMAIN)}
+    with metrics.timer(job, 'readiness'):
+        result, timings = executor_status_running(
+            tag, constants.NAMESPACE, constants.DOCKER_REPO + ":" + job['time_tag'], lambda: 'superseded_by' in job)
 
+    if result:
+        try:
+            sizing_ops.record_deployment(constants.SIZING_DB_FILE, tag, job['features'])
+        except Exception as e:
+            log.error("Deployment of %s not recorded for sizing. Exception: %s", tag, e)
 
-def download_unzip(executor_location, tag):
-    simple_ops.check_clean_path(constants.LOCAL_PATH, tag)
+    job['result'] = {'success': result, 'response': str(tag + "." + constants.DOMAIN), 'readiness': timings,
+                     'reconcile': reconcile_stats, 'sizing': job['sizing'],
+                     'prepull': prepull_ops.snapshot(job.get('prepull'))}
 
-    full_file_path = cloud_ops.download_file(
+
+# Order of the stages a job goes through, see pipeline.py for running them on separate worker pools
+STAGES = [
+    ('download', stage_download),
+    ('build', stage_build),
+    ('push', stage_push),
+    ('deploy', stage_deploy)]
+
+
+def download(executor_location, tag):
+    simple_ops.check_clean_path(constants.DOWNLOAD_PATH, tag)
+
+    return cloud_ops.download_file(
         executor_location,
         constants.CLOUD_USER,
         constants.CLOUD_PASSWORD,
-        constants.LOCAL_PATH,
+        constants.DOWNLOAD_PATH,
         tag)
 
-    simple_ops.unzip_file(
-        constants.LOCAL_PATH,
-        full_file_path,
-        tag)
 
+def build_image(job):
+    tag = job['tag']
+    archive_path = job['archive_path']
+    # keyed by tag too: an executor only reuses its own images, which invalidating the tag finds
+    job['digest'] = tag + ":" + simple_ops.get_archive_digest(archive_path)
+    cached_time_tag = cache_ops.get_cached_image(constants.BUILD_CACHE_FILE, job['digest'])
+    if cached_time_tag is not None:
+        log.debug("%s build cache hit %s, reusing image %s", tag, job['digest'], cached_time_tag)
+        metrics.inc('kubbuilder_image_cache_total', cache='build', result='hit')
+        os.remove(archive_path)
+        job['time_tag'] = cached_time_tag
+        job['cached'] = True
+        return
+
+    metrics.inc('kubbuilder_image_cache_total', cache='build', result='miss')
+    image_gc_ops.start_collector()
 
-def build_send_registry(tag):
     time_tag = tag + "-" + str(int(time.time()))
     full_tag = constants.DOCKER_REPO + ":" + time_tag
     code_path = constants.LOCAL_PATH + "/" + tag
 
-    docker_ops.image_build(
-        full_tag,
-        code_path
-    )
-
     registry_token = cloud_ops.get_registry_token(
         constants.CLOUD_USER,
         constants.CLOUD_PASSWORD,
         constants.DOCKER_REPO)
 
-    docker_ops.push_image(
-        time_tag,
-        'AWS',
-        registry_token,
-        constants.DOCKER_REPO)
-    return time_tag
-
+    # build and push stay on one daemon so the push reuses its freshly built layers,
+    # the daemon is released by push_built_image
+    daemon = docker_ops.acquire_daemon()
+    try:
+        overrides = {}
+        if constants.DEPS_LAYER_CACHE:
+            overrides = prepare_deps_image(archive_path, registry_token, daemon)
+
+        if constants.BUILD_CONTEXT_MODE == 'stream':
+            try:
+                with metrics.timer(job, 'build'):
+                    context, writer = simple_ops.zip_to_tar_stream(archive_path, overrides)
+                    docker_ops.image_build_context(
+                        full_tag,
+                        context,
+                        constants.DOCKERFILE_NAME,
+                        daemon,
+                        writer)
+            finally:
+                os.remove(archive_path)
+        else:
+            workspace_ops.acquire(tag)
+            try:
+                with metrics.timer(job, 'unzip'):
+                    job['extraction'] = workspace_ops.sync_archive(
+                        constants.LOCAL_PATH,
+                        archive_path,
+                        tag,
+                        overrides)
+                metrics.inc('kubbuilder_extracted_bytes_total', job['extraction']['bytes'])
+                with metrics.timer(job, 'build'):
+                    docker_ops.image_build(
+                        full_tag,
+                        code_path,
+                        daemon
+                    )
+            finally:
+                workspace_ops.release(tag)
+    except Exception:
+        docker_ops.release_daemon(daemon)
+        raise
+
+    image_gc_ops.touch(daemon, full_tag)
+    job['time_tag'] = time_tag
+    job['daemon'] = daemon
+
+
+def push_built_image(job):
+    if job.get('cached'):
+        return
 
-def deploy_to_kubernetes(tag, time_tag, mem_allocation):
-    image_full_name = constants.DOCKER_REPO + ":" + time_tag
-    if constants.INCLUSTER == 'true':
-        kuber_ops.connect_kubernetes()
-    else:
-        kuber_ops.connect_kubernetes(constants.KUBER_CONFIG)
+    try:
+        registry_token = cloud_ops.get_registry_token(
+            constants.CLOUD_USER,
+            constants.CLOUD_PASSWORD,
+            constants.DOCKER_REPO)
+
+        with metrics.timer(job, 'push'):
+            image_id = docker_ops.image_id(constants.DOCKER_REPO + ":" + job['time_tag'], job['daemon'])
+            job['push'] = retag_pushed_image(image_id, job['time_tag'])
+            if job['push'] is None:
+                job['push'] = docker_ops.push_image(
+                    job['time_tag'],
+                    'AWS',
+                    registry_token,
+                    constants.DOCKER_REPO,
+                    job['daemon'])
+                job['push'].update(push_savings(job['time_tag'], job['push']['pushed_bytes']))
+        metrics.inc('kubbuilder_pushed_bytes_total', job['push']['pushed_bytes'])
+        metrics.inc('kubbuilder_push_skipped_bytes_total', job['push']['skipped_bytes'])
+    finally:
+        docker_ops.release_daemon(job.pop('daemon'))
+
+    cache_ops.put_cached_image(constants.BUILD_CACHE_FILE, job['digest'], job['time_tag'])
+    cache_ops.put_cached_image(constants.IMAGE_INDEX_FILE, image_id, job['time_tag'])
+
+
+def retag_pushed_image(image_id, time_tag):
+    """
+    When an image with the same id (config digest) was pushed before, e.g. a rebuild
+    the daemon served entirely from its layer cache, its manifest gets the new tag
+    instead of pushing. Returns push stats or None when the image has to be pushed.
+    """
+    pushed_time_tag = cache_ops.get_cached_image(constants.IMAGE_INDEX_FILE, image_id)
+    if pushed_time_tag is None:
+        return None
+    try:
+        manifest = cloud_ops.get_image_manifest(
+            constants.CLOUD_USER, constants.CLOUD_PASSWORD, constants.DOCKER_REPO, pushed_time_tag)
+        if manifest is None or cloud_ops.manifest_config_digest(manifest) != image_id:
+            log.debug("%s is no longer in the registry as %s, pushing", image_id, pushed_time_tag)
+            return None
+        cloud_ops.tag_image_manifest(
+            constants.CLOUD_USER, constants.CLOUD_PASSWORD, constants.DOCKER_REPO, manifest, time_tag)
+    except Exception as e:
+        log.debug("Retagging %s as %s failed, pushing. Exception: %s", pushed_time_tag, time_tag, e)
+        return None
 
-    service = kuber_ops.create_nlu_service_object(tag)
-    hpa = kuber_ops.create_nlu_hpa_object(tag)
-    ingress = kuber_ops.create_ingress_object(tag, constants.DOMAIN)
+    skipped = cloud_ops.manifest_size(manifest)
+    log.debug("%s already pushed as %s, tagged %s without pushing %s bytes", image_id, pushed_time_tag, time_tag, skipped)
+    return {'pushed_bytes': 0, 'layers_pushed': 0, 'layers_existing': len(json.loads(manifest).get('layers', [])),
+            'skipped_bytes': skipped, 'seconds_saved': docker_ops.estimated_push_seconds(skipped),
+            'retagged_from': pushed_time_tag}
 
-    if secret_exist(constants.NLU_SECRET_NAME, constants.NAMESPACE):
-        deployment = kuber_ops.create_nlu_deployment_object(
-            image_full_name,
-            constants.NLU_SECRET_NAME,
-            tag,
-            mem_allocation)
-    else:
-        deployment = kuber_ops.create_nlu_deployment_object(
-            image_full_name,
-            None,
-            tag,
-            mem_allocation)
-
-    if service_exist(tag, constants.NAMESPACE):
-        kuber_ops.patch_nlu_service(service, constants.NAMESPACE)
-    else:
-        kuber_ops.create_nlu_service(service, constants.NAMESPACE)
 
-    if deployment_exist(tag, constants.NAMESPACE):
-        kuber_ops.replace_nlu_deployment(deployment, image_full_name, constants.NAMESPACE, tag)
-    else:
-        kuber_ops.create_nlu_deployment(deployment, constants.NAMESPACE)
+def push_savings(time_tag, pushed_bytes):
+    # the daemon skipped the layers the registry already had, their size is in the pushed manifest
+    try:
+        manifest = cloud_ops.get_image_manifest(
+            constants.CLOUD_USER, constants.CLOUD_PASSWORD, constants.DOCKER_REPO, time_tag)
+    except Exception as e:
+        log.debug("Manifest of %s not read. Exception: %s", time_tag, e)
+        manifest = None
+    if manifest is None:
+        return {'skipped_bytes': 0, 'seconds_saved': None}
+    skipped = max(cloud_ops.manifest_size(manifest) - pushed_bytes, 0)
+    return {'skipped_bytes': skipped, 'seconds_saved': docker_ops.estimated_push_seconds(skipped)}
+
+
+def abandon_job(job):
+    # a job stopped between build and push still holds its build daemon
+    if 'daemon' in job:
+        docker_ops.release_daemon(job.pop('daemon'))
+
+
+def prepare_deps_image(archive_path, registry_token, daemon):
+    files = simple_ops.read_archive_files(archive_path, [constants.DOCKERFILE_NAME, constants.REQUIREMENTS_FILE])
+    if constants.REQUIREMENTS_FILE not in files or constants.DOCKERFILE_NAME not in files:
+        log.debug("%s has no %s, building without dependency image", archive_path, constants.REQUIREMENTS_FILE)
+        return {}
+
+    dockerfile = files[constants.DOCKERFILE_NAME].decode('utf-8')
+    base_image = docker_ops.dockerfile_base_image(dockerfile)
+    if base_image is None:
+        log.debug("%s base image can't be resolved, building without dependency image", archive_path)
+        return {}
+
+    requirements = files[constants.REQUIREMENTS_FILE]
+    deps_tag = "deps-" + hashlib.sha256(base_image.encode('utf-8') + b"\0" + requirements).hexdigest()[:16]
+    try:
+        deps_image = docker_ops.ensure_deps_image(
+            deps_tag,
+            base_image,
+            requirements,
+            constants.REQUIREMENTS_FILE,
+            'AWS',
+            registry_token,
+            constants.DOCKER_REPO,
+            daemon)
+    except Exception as e:
+        # e.g. requirements with -r, -e . or local wheels, which need the rest of the archive:
+        # the executor's own Dockerfile still installs them
+        log.error("%s dependency image %s failed, building without it. Exception: %s", archive_path, deps_tag, e)
+        metrics.inc('kubbuilder_image_cache_total', cache='deps', result='failed')
+        return {}
+    image_gc_ops.touch(daemon, deps_image)
 
-    if hpa_exist(tag, constants.NAMESPACE):
-        kuber_ops.replace_nlu_hpa(hpa, constants.NAMESPACE)
-    else:
-        kuber_ops.create_nlu_hpa(hpa, constants.NAMESPACE)
+    # the executor's own pip step now finds every requirement installed and only the model layers change
+    return {constants.DOCKERFILE_NAME: docker_ops.rebase_dockerfile(dockerfile, deps_image).encode('utf-8')}
 
-    if ingress_exist(tag, constants.NAMESPACE):
-        kuber_ops.replace_nlu_ingress(ingress, constants.NAMESPACE)
-    else:
-        kuber_ops.create_nlu_ingress(ingress, constants.NAMESPACE)
 
+def invalidate_build_cache(host_path=None):
+    if host_path is None:
+        return cache_ops.invalidate(constants.BUILD_CACHE_FILE)
+    tag = ('-'.join(host_path)).lower()
+    return cache_ops.invalidate(constants.BUILD_CACHE_FILE, tag)
 
-def deployment_exist(name, namespace):
-    result = True
-    try:
-        kuber_ops.get_nlu_deployment(name, namespace)
-    except Exception as e:
-        log.debug("Deployment %s doesn't exist. Exception: %s" % (name, e))
-        result = False
-    return result
 
+def deploy_to_kubernetes(tag, time_tag, sizing):
+    connect_kubernetes()
+    sizing_ops.start_sampler(constants.SIZING_DB_FILE, constants.NAMESPACE)
 
-def service_exist(name, namespace):
-    result = True
-    try:
-        kuber_ops.get_nlu_service(name, namespace)
-    except Exception as e:
-        log.debug("Service %s doesn't exist. Exception: %s" % (name, e))
-        result = False
-    return result
+    stats = {'writes': 0, 'skipped': 0}
+    reconcile_executor(tag, time_tag, sizing, stats)
+    log.debug("%s reconciled: %s writes, %s writes avoided", tag, stats['writes'], stats['skipped'])
+    return stats
 
 
-def hpa_exist(name, namespace):
-    result = True
-    try:
-        kuber_ops.get_nlu_hpa(name, namespace)
-    except Exception as e:
-        log.debug("HPA %s doesn't exist. Exception: %s" % (name, e))
-        result = False
-    return result
+def reconcile_executor(tag, time_tag, sizing, stats):
+    image_full_name = constants.DOCKER_REPO + ":" + time_tag
+    service = kuber_ops.create_nlu_service_object(tag)
+    hpa = kuber_ops.create_nlu_hpa_object(tag)
+    ingress = kuber_ops.create_ingress_object(tag, constants.DOMAIN)
 
+    # env vars come from the informer's copy of the secret, kept current by its watch
+    deployment = kuber_ops.create_nlu_deployment_object(
+        image_full_name,
+        informer_ops.get('secret', constants.NLU_SECRET_NAME, constants.NAMESPACE),
+        tag,
+        sizing['memory'],
+        sizing['cpu'],
+        sizing['memory_limit'])
+
+    for kind, desired in (('service', service), ('deployment', deployment), ('hpa', hpa), ('ingress', ingress)):
+        live = informer_ops.get(kind, tag, constants.NAMESPACE)
+        informer_ops.store(kind, constants.NAMESPACE,
+                           reconcile_ops.reconcile(kind, desired, live, constants.NAMESPACE, stats))
+
+
+def stage_deploy_batch(jobs):
+    """
+    Deploy stage for the jobs of a batch: one reconcile pass over all their objects
+    and one pod watch for all their rollouts. A job whose objects fail to reconcile
+    gets its own 'error' and is left out of the watch.
+    """
+    # superseded while waiting for the rest of the batch: the newer job deploys the executor
+    jobs = [job for job in jobs if 'superseded_by' not in job]
+    if not jobs:
+        return
+    connect_kubernetes()
+    sizing_ops.start_sampler(constants.SIZING_DB_FILE, constants.NAMESPACE)
+
+    stats = {}
+    reconciled = []
+    for job in jobs:
+        stats[job['tag']] = {'writes': 0, 'skipped': 0}
+        try:
+            with metrics.timer(job, 'deploy'):
+                reconcile_executor(job['tag'], job['time_tag'], job['sizing'], stats[job['tag']])
+        except Exception:
+            job['error'] = traceback.format_exc()
+            log.error("Job %s failed to reconcile: %s", job.get('request_id'), job['error'])
+            job['deploy_finished'] = time.time()
+            continue
+        reconciled.append(job)
+    log.debug("Batch of %s reconciled: %s", len(jobs), stats)
+    if not reconciled:
+        return
+
+    rollouts = dict((job['tag'], (constants.DOCKER_REPO + ":" + job['time_tag'],
+                                  lambda job=job: 'superseded_by' in job))
+                    for job in reconciled)
+    started = time.time()
+    finished_at = {}
+    statuses = executors_status_running(rollouts, constants.NAMESPACE, finished_at)
+
+    for job in reconciled:
+        result, timings = statuses[job['tag']]
+        job['deploy_finished'] = finished_at.get(job['tag'], time.time())
+        elapsed = job['deploy_finished'] - started
+        job.setdefault('timings', {})['readiness'] = round(elapsed, 3)
+        metrics.observe('kubbuilder_phase_duration_seconds', elapsed, phase='readiness')
+        if result:
+            try:
+                sizing_ops.record_deployment(constants.SIZING_DB_FILE, job['tag'], job['features'])
+            except Exception as e:
+                log.error("Deployment of %s not recorded for sizing. Exception: %s", job['tag'], e)
+        job['result'] = {'success': result, 'response': str(job['tag'] + "." + constants.DOMAIN),
+                         'readiness': timings, 'reconcile': stats[job['tag']], 'sizing': job['sizing'],
+                         'prepull': prepull_ops.snapshot(job.get('prepull'))}
+
+
+def executors_status(prefix=None, status=None, offset=0, limit=None):
+    """
+    Status of every executor in the namespace from the informers' caches, one list call
+    per kind while they aren't synced. Executors are sorted by tag and can be filtered
+    by tag prefix and status ('available', 'progressing' or 'unavailable'). 'total'
+    counts the executors matching the filters, 'unfiltered' all of them.
+    offset >= 0 and limit >= 1 are checked by the caller, limit is capped at
+    EXECUTORS_MAX_PAGE_SIZE.
+    """
+    connect_kubernetes()
+    if limit is None:
+        limit = constants.EXECUTORS_PAGE_SIZE
+    limit = min(limit, constants.EXECUTORS_MAX_PAGE_SIZE)
+    by_name = {}
+    for kind in ('service', 'hpa', 'ingress'):
+        by_name[kind] = dict((r.metadata.name, r) for r in informer_ops.list_items(kind, constants.NAMESPACE))
+
+    executors = []
+    unfiltered = 0
+    for deployment in sorted(informer_ops.list_items('deployment', constants.NAMESPACE), key=lambda d: d.metadata.name):
+        tag = deployment.metadata.name
+        labels = deployment.spec.template.metadata.labels or {}
+        if labels.get('app') != tag:
+            continue
+        unfiltered += 1
+        if prefix and not tag.startswith(prefix):
+            continue
+        executor = executor_status(deployment, by_name['hpa'].get(tag), by_name['ingress'].get(tag),
+                                   by_name['service'].get(tag))
+        if status and executor['status'] != status:
+            continue
+        executors.append(executor)
+
+    return {'total': len(executors), 'unfiltered': unfiltered, 'offset': offset, 'limit': limit,
+            'executors': executors[offset:offset + limit]}
+
+
+def executor_status(deployment, hpa, ingress, service):
+    image = deployment.spec.template.spec.containers[0].image
+    time_tag = image.rpartition(":")[2]
+    epoch = time_tag.rpartition("-")[2]
+    if epoch.isdigit():
+        deployed_at = int(epoch)
+    elif deployment.metadata.creation_timestamp is not None:
+        deployed_at = int(deployment.metadata.creation_timestamp.timestamp())
+    else:
+        deployed_at = None
+
+    replicas = {
+        'desired': deployment.spec.replicas or 0,
+        'updated': deployment.status.updated_replicas or 0,
+        'ready': deployment.status.ready_replicas or 0,
+        'available': deployment.status.available_replicas or 0}
+    if replicas['available'] < constants.READINESS_MIN_REPLICAS:
+        status = 'unavailable'
+    elif replicas['updated'] < replicas['desired'] or replicas['available'] < replicas['desired']:
+        status = 'progressing'
+    else:
+        status = 'available'
 
-def ingress_exist(name, namespace):
-    result = True
-    try:
-        kuber_ops.get_nlu_ingress(name, namespace)
-    except Exception as e:
-        log.debug("Ingress %s doesn't exist. Exception: %s" % (name, e))
-        result = False
-    return result
+    hpa_status = None
+    if hpa is not None:
+        hpa_status = {
+            'min_replicas': hpa.spec.min_replicas,
+            'max_replicas': hpa.spec.max_replicas,
+            'current_replicas': hpa.status.current_replicas,
+            'desired_replicas': hpa.status.desired_replicas,
+            'current_cpu_utilization': hpa.status.current_cpu_utilization_percentage}
 
+    host = None
+    if ingress is not None and ingress.spec.rules:
+        host = ingress.spec.rules[0].host
 
-def secret_exist(name, namespace):
-    result = True
-    try:
-        kuber_ops.get_nlu_secret(name, namespace)
-    except Exception as e:
-        log.debug("Secret %s doesn't exist. Exception: %s" % (name, e))
-        result = False
-    return result
+    return {'tag': deployment.metadata.name, 'status': status, 'image': image, 'deployed_at': deployed_at,
+            'replicas': replicas, 'hpa': hpa_status, 'host': host, 'service': service is not None}
 
 
 def to_base64(string):
@@ -172,65 +471,207 @@ def dict_to_base64(variables_dict):
     return variables_dict
 
 
+def connect_kubernetes():
+    # the kubeconfig is loaded and the informers started once per process, not on every request
+    with connect_lock:
+        if not connection['connected']:
+            if constants.INCLUSTER == 'true':
+                kuber_ops.connect_kubernetes()
+            else:
+                kuber_ops.connect_kubernetes(constants.KUBER_CONFIG)
+            connection['connected'] = True
+    informer_ops.start_informers(constants.NAMESPACE)
+
+
 def create_secret(secret_name, variables_dict):
     secret = kuber_ops.create_secret_object(secret_name, dict_to_base64(variables_dict))
-    kuber_ops.create_secret(secret)
+    return kuber_ops.create_secret(secret, constants.NAMESPACE)
 
 
 def update_secret(secret_name, variables_dict):
-    secret = kuber_ops.get_nlu_secret(secret_name)
-    secret.data.update(dict_to_base64(variables_dict))
-    kuber_ops.update_secret(secret)
+    """
+    Patches only the keys whose value changed.
+    Returns the updated secret or None when nothing changed.
+    """
+    secret = informer_ops.get('secret', secret_name, constants.NAMESPACE)
+    if secret is None:
+        return create_secret(secret_name, variables_dict)
+
+    live = secret.data or {}
+    changed = dict((key, to_base64(value)) for key, value in variables_dict.items()
+                   if live.get(key) != to_base64(value))
+    if not changed:
+        log.debug("Secret %s already has the requested values, skipping write", secret_name)
+        return None
+    return kuber_ops.patch_resource('secret', secret_name, constants.NAMESPACE, {'data': changed})
+
+
+def write_secret_batch(secret_name, batch):
+    # runs under secret_write_lock: detach the batch so later updates start a new one
+    with secret_lock:
+        if secret_batch.get(secret_name) is batch:
+            del secret_batch[secret_name]
+    try:
+        informer_ops.store('secret', constants.NAMESPACE, update_secret(secret_name, batch['variables']))
+    except Exception as e:
+        batch['error'] = e
+    batch['done'].set()
 
 
-def run_secret(variables_dict):
-    kuber_ops.connect_kubernetes(constants.KUBER_CONFIG)
+def run_secret(variables):
+    """
+    Sets the variables in the NLU secret. variables is a dict or a list of dicts
+    applied in order; updates arriving while a write is in flight are merged
+    into the next patch.
+    """
+    connect_kubernetes()
     secret_name = constants.NLU_SECRET_NAME
-
-    if secret_exist(secret_name):
-        update_secret(secret_name, variables_dict)
+    updates = variables if isinstance(variables, list) else [variables]
+
+    with secret_lock:
+        batch = secret_batch.get(secret_name)
+        if batch is None:
+            batch = secret_batch[secret_name] = {'variables': {}, 'requests': 0, 'error': None,
+                                                 'done': threading.Event()}
+        for update in updates:
+            batch['variables'].update(update)
+        batch['requests'] += 1
+
+    with secret_write_lock:
+        if not batch['done'].is_set():
+            write_secret_batch(secret_name, batch)
+
+    if batch['error'] is not None:
+        raise batch['error']
+    return {'success': True, 'keys': sum(len(u) for u in updates), 'coalesced': batch['requests']}
+
+
+def executor_status_running(tag, namespace, image_full_name, cancelled=None):
+    return executors_status_running({tag: (image_full_name, cancelled)}, namespace)[tag]
+
+
+def executors_status_running(rollouts, namespace, finished_at=None):
+    # Follows the rollouts' pods through one watch: a rollout is done as soon as enough of
+    # its pods are ready, fails fast on a pod stuck in a known failure state and records
+    # when pods got scheduled, pulled their image and became ready (seconds since the wait
+    # started). rollouts maps tag to (image_full_name, cancelled), returns tag to (bool, timings).
+    # finished_at, when given, gets the time each rollout's outcome was known.
+    start = time.time()
+    deadline = start + constants.READINESS_TIMEOUT
+    if len(rollouts) == 1:
+        label_selector = "app=" + list(rollouts)[0]
     else:
-        create_secret(secret_name, variables_dict)
-
-    return {'success': True}
-
-
-def executor_status_running(tag, namespace):
-    attempts = range(0, 60)
-    fqdn = tag + "." + constants.DOMAIN
-    delay = 10
-
-    for attempt in attempts:
-        available_replicas_count = int(kuber_ops.get_deployment_status(namespace, tag).status.available_replicas or 0)
-        if executor_available(available_replicas_count, fqdn):
-            log.debug("Deployment %s created" % str(tag))
-            return True
-        log.debug("Attempt: %s. Deployment %s isn't ready, sleeping for %s & trying again" % (
-            str(attempt),
-            str(tag),
-            str(delay)))
-        time.sleep(delay)
-
-    log.debug("Deployment %s wasn't created" % str(tag))
-    return False
-
-
-def executor_available(available_replicas_count, fqdn):
-    if available_replicas_count >= 2 or hostname_resolves(fqdn):
-        return True
-    else:
-        return False
-
-
-def hostname_resolves(hostname):
-    try:
-        socket.gethostbyname(hostname)
-        return True
-    except socket.error:
-        return False
-
-
-def get_memory_reservation(path, files_list):
-    training_data_size = simple_ops.get_training_data_size(path, files_list)
-    memory = (constants.MALLOCATION_COEFICIENT * training_data_size + constants.MALLOCATION_CONSTANT) * constants.MALLOCATION_ALLOWANCE
-    return memory
+        label_selector = "app in (%s)" % ",".join(sorted(rollouts))
+    timings = dict((tag, {}) for tag in rollouts)
+    ready_pods = dict((tag, set()) for tag in rollouts)
+    statuses = {}
+    finished_at = finished_at if finished_at is not None else {}
+    events = None
+    resource_version = None
+    failures = 0
+
+    while time.time() < deadline:
+        try:
+            if events is None:
+                pods = kuber_ops.list_pods(namespace, label_selector)
+                # the watch resumes from the list, the items carry their own older versions
+                resource_version = pods.metadata.resource_version
+                events = [{'type': 'ADDED', 'object': pod, 'listed': True} for pod in pods.items]
+            for event in events:
+                if event['type'] == 'ERROR':
+                    raise Exception("Watch error: %s" % event['object'])
+                for tag, (image_full_name, cancelled) in rollouts.items():
+                    if tag not in statuses and cancelled is not None and cancelled():
+                        log.debug("Waiting for deployment %s cancelled, timings: %s", tag, timings[tag])
+                        timings[tag]['cancelled'] = True
+                        statuses[tag] = (False, timings[tag])
+                        finished_at[tag] = time.time()
+                if len(statuses) == len(rollouts):
+                    return statuses
+
+                pod = event['object']
+                if not event.get('listed'):
+                    resource_version = pod.metadata.resource_version
+                    failures = 0
+                tag = (pod.metadata.labels or {}).get('app')
+                if tag not in rollouts or tag in statuses:
+                    continue
+                if event['type'] == 'DELETED' or not rollout_pod(pod, rollouts[tag][0]):
+                    ready_pods[tag].discard(pod.metadata.name)
+                    continue
+
+                failure = pod_failure_reason(pod)
+                if failure is not None:
+                    log.debug("Deployment %s failed: pod %s is in %s, timings: %s",
+                              tag, pod.metadata.name, failure, timings[tag])
+                    timings[tag]['failure'] = failure
+                    statuses[tag] = (False, timings[tag])
+                    finished_at[tag] = time.time()
+                else:
+                    record_pod_phases(pod, timings[tag], start)
+                    if pod_condition(pod, 'Ready'):
+                        ready_pods[tag].add(pod.metadata.name)
+                    else:
+                        ready_pods[tag].discard(pod.metadata.name)
+
+                    if len(ready_pods[tag]) >= constants.READINESS_MIN_REPLICAS:
+                        log.debug("Deployment %s created, timings: %s", tag, timings[tag])
+                        statuses[tag] = (True, timings[tag])
+                        finished_at[tag] = time.time()
+
+                if len(statuses) == len(rollouts):
+                    return statuses
+        except Exception as e:
+            # e.g. 410 Gone for an expired resourceVersion: start over from a fresh list
+            log.debug("Watch for %s interrupted, relisting. Exception: %s", label_selector, e, extra=RATE_LIMITED)
+            events = None
+            time.sleep(max(min(constants.READINESS_RETRY_DELAY * 2 ** failures, constants.READINESS_RETRY_MAX_DELAY,
+                               deadline - time.time()), 0))
+            failures += 1
+            continue
+
+        events = kuber_ops.watch_pods(namespace, label_selector, resource_version, int(deadline - time.time()) + 1)
+
+    for tag in rollouts:
+        if tag not in statuses:
+            log.debug("Deployment %s wasn't created, timings: %s", tag, timings[tag])
+            statuses[tag] = (False, timings[tag])
+            finished_at[tag] = time.time()
+    return statuses
+
+
+def rollout_pod(pod, image_full_name):
+    return any(c.image == image_full_name for c in pod.spec.containers)
+
+
+def pod_condition(pod, condition_type):
+    return any(c.type == condition_type and c.status == "True" for c in (pod.status.conditions or []))
+
+
+def pod_failure_reason(pod):
+    if pod.status.phase == "Failed":
+        return "Failed"
+    for status in pod.status.container_statuses or []:
+        waiting = status.state.waiting if status.state else None
+        if waiting is not None and waiting.reason in constants.READINESS_FAILURE_REASONS:
+            return waiting.reason
+    return None
+
+
+def record_pod_phases(pod, timings, start):
+    elapsed = round(time.time() - start, 3)
+    if pod_condition(pod, 'PodScheduled'):
+        timings.setdefault('scheduled', elapsed)
+    if any(s.image_id for s in pod.status.container_statuses or []) and 'pulled' not in timings:
+        timings['pulled'] = elapsed
+        # the image pull is its own phase: from scheduling until the image is on the node
+        timings['pull'] = round(elapsed - timings.get('scheduled', 0), 3)
+        metrics.observe('kubbuilder_phase_duration_seconds', timings['pull'], phase='pull')
+    if pod_condition(pod, 'Ready'):
+        timings.setdefault('ready', elapsed)
+
+
+def get_archive_features(archive_path, files_list):
+    return {
+        'training_size': simple_ops.get_archive_data_size(archive_path, files_list),
+        'archive_size': simple_ops.get_archive_uncompressed_size(archive_path)}
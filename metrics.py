@@ -0,0 +1,103 @@
+import constants
+import threading
+import time
+from contextlib import contextmanager
+
+lock = threading.Lock()
+counters = {}
+gauges = {}
+histograms = {}
+
+DESCRIPTIONS = {
+    'kubbuilder_phase_duration_seconds': ('histogram', 'Duration of each phase of a build job'),
+    'kubbuilder_stage_wait_seconds': ('histogram', 'Time a job waited in a pipeline stage queue'),
+    'kubbuilder_downloaded_bytes_total': ('counter', 'Bytes of executor archives downloaded'),
+    'kubbuilder_extracted_bytes_total': ('counter', 'Bytes extracted from executor archives'),
+    'kubbuilder_pushed_bytes_total': ('counter', 'Bytes of image layers pushed to the registry'),
+    'kubbuilder_push_skipped_bytes_total': ('counter', 'Image bytes the registry already had and were not pushed'),
+    'kubbuilder_jobs_total': ('counter', 'Finished jobs by outcome'),
+    'kubbuilder_queue_depth': ('gauge', 'Jobs waiting in a pipeline stage queue'),
+    'kubbuilder_jobs_in_flight': ('gauge', 'Jobs being processed by a pipeline stage'),
+    'kubbuilder_callbacks_total': ('counter', 'Callback delivery attempts by outcome'),
+    'kubbuilder_callback_duration_seconds': ('histogram', 'Duration of a callback POST by outcome'),
+    'kubbuilder_callback_latency_seconds': ('histogram', 'Time from queueing a callback to its delivery'),
+    'kubbuilder_callback_queue_depth': ('gauge', 'Callbacks waiting to be delivered'),
+    'kubbuilder_image_cache_total': ('counter', 'Build cache and dependency image lookups by result'),
+    'kubbuilder_image_disk_bytes': ('gauge', 'Bytes of image layers on a docker daemon'),
+    'kubbuilder_image_gc_removed_total': ('counter', 'Executor images removed by the image GC'),
+    'kubbuilder_image_gc_reclaimed_bytes_total': ('counter', 'Bytes of image layers reclaimed by the image GC'),
+    'kubbuilder_log_records_dropped_total': ('counter', 'Log records dropped by the full queue or rate limiting'),
+}
+
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with lock:
+        key = (name, labels_key(labels))
+        counters[key] = counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with lock:
+        gauges[(name, labels_key(labels))] = value
+
+
+def observe(name, value, **labels):
+    with lock:
+        key = (name, labels_key(labels))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {'buckets': [0] * len(constants.METRICS_BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(constants.METRICS_BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+@contextmanager
+def timer(job, phase):
+    """
+    Times the block into the job's timings and the phase duration histogram
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        if job is not None:
+            job.setdefault('timings', {})[phase] = round(elapsed, 3)
+        observe('kubbuilder_phase_duration_seconds', elapsed, phase=phase)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+def render():
+    lines = []
+    with lock:
+        samples = {}
+        for (name, labels), value in sorted(counters.items()):
+            samples.setdefault(name, []).append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), value in sorted(gauges.items()):
+            samples.setdefault(name, []).append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            series = samples.setdefault(name, [])
+            for bound, count in zip(constants.METRICS_BUCKETS, histogram['buckets']):
+                series.append('%s_bucket%s %s' % (name, format_labels(labels + (('le', bound),)), count))
+            series.append('%s_bucket%s %s' % (name, format_labels(labels + (('le', '+Inf'),)), histogram['count']))
+            series.append('%s_sum%s %s' % (name, format_labels(labels), histogram['sum']))
+            series.append('%s_count%s %s' % (name, format_labels(labels), histogram['count']))
+
+    for name in sorted(samples):
+        metric_type, description = DESCRIPTIONS.get(name, ('untyped', name))
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        lines.extend(samples[name])
+    return '\n'.join(lines) + '\n'
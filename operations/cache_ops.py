@@ -0,0 +1,73 @@
+import json
+import os
+import threading
+import time
+import constants
+from coralogger import get_default_logger
+
+log = get_default_logger()
+
+cache_lock = threading.Lock()
+
+
+def load_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except ValueError as e:
+        log.error("Build cache %s is corrupted, starting empty. Exception: %s", cache_file, e)
+        return {}
+
+
+def save_cache(cache_file, cache):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_file, cache_file)
+
+
+def evict(cache, max_entries, ttl):
+    now = time.time()
+    for digest in [d for d, entry in cache.items() if now - entry['created'] > ttl]:
+        log.debug("Build cache entry %s expired", digest)
+        del cache[digest]
+    if len(cache) > max_entries:
+        lru = sorted(cache, key=lambda d: cache[d]['last_used'])
+        for digest in lru[:len(cache) - max_entries]:
+            log.debug("Build cache entry %s evicted", digest)
+            del cache[digest]
+    return cache
+
+
+def get_cached_image(cache_file, digest):
+    with cache_lock:
+        cache = evict(load_cache(cache_file), constants.BUILD_CACHE_MAX_ENTRIES, constants.BUILD_CACHE_TTL)
+        entry = cache.get(digest)
+        if entry is not None:
+            entry['last_used'] = time.time()
+        save_cache(cache_file, cache)
+    return entry['time_tag'] if entry is not None else None
+
+
+def put_cached_image(cache_file, digest, time_tag):
+    now = time.time()
+    with cache_lock:
+        cache = load_cache(cache_file)
+        cache[digest] = {'time_tag': time_tag, 'created': now, 'last_used': now}
+        save_cache(cache_file, evict(cache, constants.BUILD_CACHE_MAX_ENTRIES, constants.BUILD_CACHE_TTL))
+
+
+def invalidate(cache_file, tag=None):
+    # time_tag is "<tag>-<epoch>", so an executor's entries are found by stripping the epoch
+    with cache_lock:
+        cache = load_cache(cache_file)
+        removed = [d for d, entry in cache.items()
+                   if tag is None or entry['time_tag'].rsplit("-", 1)[0] == tag]
+        for digest in removed:
+            del cache[digest]
+        save_cache(cache_file, cache)
+    log.debug("Build cache invalidated %s entries for %s", len(removed), tag or "all tags")
+    return len(removed)
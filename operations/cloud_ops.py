@@ -1,6 +1,44 @@
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 import base64
+import hashlib
+import json
+import threading
+import time
+import constants
+import tracing
+from coralogger import get_default_logger
+
+log = get_default_logger()
+
+sessions_lock = threading.Lock()
+sessions = {}
+clients = {}
+tokens_lock = threading.Lock()
+tokens = {}
+
+
+def get_session(cloud_user, cloud_password):
+    # boto3 sessions aren't thread safe, they are only used under the lock to create clients
+    key = (cloud_user, cloud_password, constants.CLOUD_REGION)
+    if key not in sessions:
+        sessions[key] = boto3.Session(
+            aws_access_key_id=cloud_user,
+            aws_secret_access_key=cloud_password,
+            region_name=constants.CLOUD_REGION)
+    return sessions[key]
+
+
+def get_client(service_name, cloud_user, cloud_password, endpoint_url=None):
+    key = (service_name, cloud_user, cloud_password, constants.CLOUD_REGION, endpoint_url)
+    with sessions_lock:
+        if key not in clients:
+            clients[key] = get_session(cloud_user, cloud_password).client(
+                service_name=service_name,
+                region_name=constants.CLOUD_REGION,
+                endpoint_url=endpoint_url)
+        return clients[key]
 
 
 def download_file(url, cloud_user, cloud_password, local_path, tag):
@@ -10,29 +48,136 @@ def download_file(url, cloud_user, cloud_password, local_path, tag):
 
     key_name = parsed_url.path[len(path[1])+2:]
     full_path = local_path+"/"+tag+"/"+path[-1]
-    session = boto3.Session(
-        aws_access_key_id=cloud_user,
-        aws_secret_access_key=cloud_password,
-        region_name='us-west-2')
-    s3_client = session.resource('s3')
-    s3_client.Bucket(bucket_name).download_file(key_name,full_path)
+    s3_client = get_client('s3', cloud_user, cloud_password, constants.S3_ENDPOINT_URL)
+
+    start = time.time()
+    head = s3_client.head_object(Bucket=bucket_name, Key=key_name)
+    size = head['ContentLength']
+    etag = head['ETag'].strip('"')
+
+    ranges = split_ranges(size, constants.DOWNLOAD_CHUNK_SIZE)
+    preallocate_file(full_path, size)
+    with ThreadPoolExecutor(constants.DOWNLOAD_WORKERS) as pool:
+        futures = [pool.submit(download_range, s3_client, bucket_name, key_name, etag, full_path, first, last)
+                   for first, last in ranges]
+        for future in futures:
+            future.result()
+
+    if constants.DOWNLOAD_VERIFY_CHECKSUM:
+        verify_etag(head, key_name, etag, full_path)
+
+    elapsed = time.time() - start
+    tracing.annotate(bytes=size, bucket=bucket_name, key=key_name, ranges=len(ranges))
+    log.debug("%s downloaded %s bytes in %.2fs (%.2f MB/s, %s ranges)",
+              tag, size, elapsed, size / (1024 * 1024) / max(elapsed, 0.001), len(ranges))
 
     return full_path
 
 
-def get_registry_token(cloud_user,cloud_password,registry):
-    session = boto3.Session(
-        aws_access_key_id=cloud_user,
-        aws_secret_access_key=cloud_password,
-        region_name='us-west-2')
-    ecr_client = session.client(
-        service_name='ecr',
-        region_name='us-west-2')
+def split_ranges(size, chunk_size):
+    return [(first, min(first + chunk_size, size) - 1) for first in range(0, size, chunk_size)]
 
-    response = ecr_client.get_authorization_token(registryIds=[registry.split(".")[0]])
-    token = (base64.b64decode(response['authorizationData'][0]['authorizationToken'])).decode("utf-8").split(":")[1]
 
-    return token
+def preallocate_file(full_path, size):
+    with open(full_path, 'wb') as f:
+        f.truncate(size)
+
+
+def download_range(s3_client, bucket_name, key_name, etag, full_path, first, last):
+    # IfMatch guards against the object being replaced while the ranges are in flight
+    response = s3_client.get_object(
+        Bucket=bucket_name,
+        Key=key_name,
+        Range="bytes=%s-%s" % (first, last),
+        IfMatch=etag)
+    body = response['Body']
+    with open(full_path, 'r+b') as f:
+        f.seek(first)
+        for chunk in iter(lambda: body.read(1024 * 1024), b''):
+            f.write(chunk)
+        written = f.tell() - first
+    if written != last - first + 1:
+        raise IOError("Range %s-%s of %s is short: %s bytes" % (first, last, key_name, written))
+
+
+def verify_etag(head, key_name, etag, full_path):
+    # The ETag is the md5 of the object only for single part uploads without SSE-KMS or SSE-C:
+    # multipart ETags depend on part sizes the object doesn't record, encrypted ones are opaque
+    if '-' in etag or len(etag) != 32 or head.get('ServerSideEncryption') == 'aws:kms' or \
+            head.get('SSECustomerAlgorithm'):
+        log.debug("%s ETag %s isn't an md5, checksum not verified", key_name, etag)
+        return
 
+    local_etag = file_md5(full_path)
+    if local_etag != etag:
+        raise IOError("Checksum mismatch for %s: expected %s, got %s" % (key_name, etag, local_etag))
+    log.debug("%s checksum verified: %s", key_name, etag)
 
 
+def file_md5(full_path):
+    md5 = hashlib.md5()
+    with open(full_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def ecr_repository(docker_repo):
+    # <registry id>.dkr.ecr.<region>.amazonaws.com/<repository name>
+    registry, _, repository_name = docker_repo.partition("/")
+    return registry.split(".")[0], repository_name
+
+
+def get_image_manifest(cloud_user, cloud_password, docker_repo, image_tag):
+    """
+    Returns the image's schema 2 manifest as a string, None when the tag isn't in the repository
+    """
+    registry_id, repository_name = ecr_repository(docker_repo)
+    ecr_client = get_client('ecr', cloud_user, cloud_password, constants.ECR_ENDPOINT_URL)
+    response = ecr_client.batch_get_image(
+        registryId=registry_id,
+        repositoryName=repository_name,
+        imageIds=[{'imageTag': image_tag}],
+        acceptedMediaTypes=['application/vnd.docker.distribution.manifest.v2+json'])
+    if not response['images']:
+        return None
+    return response['images'][0]['imageManifest']
+
+
+def manifest_config_digest(manifest):
+    return json.loads(manifest).get('config', {}).get('digest')
+
+
+def manifest_size(manifest):
+    manifest = json.loads(manifest)
+    return manifest.get('config', {}).get('size', 0) + sum(l.get('size', 0) for l in manifest.get('layers', []))
+
+
+def tag_image_manifest(cloud_user, cloud_password, docker_repo, manifest, image_tag):
+    # adds a tag to a manifest already in the repository, no layer is uploaded
+    registry_id, repository_name = ecr_repository(docker_repo)
+    ecr_client = get_client('ecr', cloud_user, cloud_password, constants.ECR_ENDPOINT_URL)
+    ecr_client.put_image(
+        registryId=registry_id,
+        repositoryName=repository_name,
+        imageManifest=manifest,
+        imageTag=image_tag)
+    log.debug("Manifest tagged %s:%s", docker_repo, image_tag)
+
+
+def get_registry_token(cloud_user,cloud_password,registry):
+    key = (cloud_user, registry)
+    with tokens_lock:
+        cached = tokens.get(key)
+        if cached is not None and cached[1] - time.time() > constants.REGISTRY_TOKEN_REFRESH_MARGIN:
+            return cached[0]
+
+        ecr_client = get_client('ecr', cloud_user, cloud_password, constants.ECR_ENDPOINT_URL)
+        response = ecr_client.get_authorization_token(registryIds=[registry.split(".")[0]])
+        authorization = response['authorizationData'][0]
+        token = (base64.b64decode(authorization['authorizationToken'])).decode("utf-8").split(":")[1]
+        expires_at = authorization['expiresAt'].timestamp()
+        tokens[key] = (token, expires_at)
+        log.debug("Registry token for %s refreshed, expires in %ss", registry, int(expires_at - time.time()))
+
+    return token
@@ -1,40 +1,210 @@
 import docker
+import io
+import re
+import tarfile
+import threading
+import time
+import constants
+import metrics
+import tracing
 from coralogger import get_default_logger
 
 log = get_default_logger()
 
+daemons_lock = threading.Lock()
+daemons = {}
+push_throughput = {'bytes_per_second': None}
 
-def remove_old_images():
-    client = docker.DockerClient(base_url='tcp://127.0.0.1:2375')
-    all_images = client.images.list()
-    for i in all_images:
-        if i.tags != ['python:3.5-jessie']:
-            log.debug("image %s removed" % str(i.tags) )
-            client.images.remove(i.short_id.split(":")[-1], force=True)
-        else:
-            log.debug("No images to remove")
 
+def get_daemon(base_url):
+    with daemons_lock:
+        if base_url not in daemons:
+            daemons[base_url] = {
+                'client': docker.DockerClient(base_url=base_url),
+                'active': 0,
+                'healthy': True,
+                'checked': 0,
+                'logins': {}}
+        return daemons[base_url]
 
-def image_build(full_tag, code_path):
-    client = docker.DockerClient(base_url='tcp://127.0.0.1:2375')
+
+def get_client(base_url=None):
+    return get_daemon(base_url or constants.DOCKER_DAEMONS[0])['client']
+
+
+def check_daemon_health(base_url):
+    daemon = get_daemon(base_url)
+    if time.time() - daemon['checked'] < constants.DOCKER_HEALTHCHECK_INTERVAL:
+        return daemon['healthy']
+    try:
+        daemon['client'].ping()
+        healthy = True
+    except Exception as e:
+        log.error("Docker daemon %s failed health check. Exception: %s", base_url, e)
+        healthy = False
+    daemon['healthy'] = healthy
+    daemon['checked'] = time.time()
+    return healthy
+
+
+def acquire_daemon():
+    healthy = [base_url for base_url in constants.DOCKER_DAEMONS if check_daemon_health(base_url)]
+    if not healthy:
+        raise Exception("No healthy docker daemon in %s" % constants.DOCKER_DAEMONS)
+    with daemons_lock:
+        base_url = min(healthy, key=lambda url: daemons[url]['active'])
+        daemons[base_url]['active'] += 1
+        log.debug("Docker daemon %s acquired, active builds: %s", base_url, daemons[base_url]['active'])
+    return base_url
+
+
+def release_daemon(base_url):
+    with daemons_lock:
+        daemons[base_url]['active'] -= 1
+
+
+def image_build(full_tag, code_path, base_url=None):
+    client = get_client(base_url)
     response = client.images.build(
         path=code_path,
         dockerfile=code_path + "/Dockerfile.nlu",
         tag=full_tag)
-    log.debug("Docker image build, response: %s" % response)
-
-
-def push_image(tag_name, repo_user, repo_password, docker_repo):
-    client = docker.DockerClient(base_url='tcp://127.0.0.1:2375')
-    client.login(
-        username=repo_user,
-        password=repo_password,
-        registry=docker_repo,
-        email=None,
-        reauth=True)
-
-    client.images.push(
-        repository=docker_repo,
-        tag=tag_name)
-    log.debug("Image %s:%s pushed successful" % (docker_repo, tag_name))
-    return tag_name
+    log.debug("Docker image build, response: %s", response)
+
+
+def image_build_context(full_tag, context, dockerfile, base_url=None, writer=None):
+    # writer is the context's writer thread from simple_ops.zip_to_tar_stream: the daemon
+    # accepts a tar cut at a header boundary, so a build from a context that ended early fails here
+    client = get_client(base_url)
+    try:
+        response = client.images.build(
+            fileobj=context,
+            custom_context=True,
+            dockerfile=dockerfile,
+            tag=full_tag)
+    finally:
+        context.close()
+        if writer is not None:
+            writer['thread'].join()
+    if writer is not None and writer['error'] is not None:
+        raise IOError("Build context of %s is incomplete: %s" % (full_tag, writer['error']))
+    log.debug("Docker image build from stream, response: %s", response)
+
+
+def dockerfile_base_image(dockerfile):
+    match = re.search(r'^\s*FROM\s+(\S+)', dockerfile, re.MULTILINE | re.IGNORECASE)
+    if match is None or '$' in match.group(1):
+        return None
+    return match.group(1)
+
+
+def rebase_dockerfile(dockerfile, image_full_name):
+    return re.sub(r'^(\s*FROM\s+)\S+', lambda m: m.group(1) + image_full_name, dockerfile,
+                  count=1, flags=re.MULTILINE | re.IGNORECASE)
+
+
+def deps_build_context(base_image, requirements, requirements_name):
+    dockerfile = ("FROM %s\n"
+                  "COPY %s /deps/%s\n"
+                  "RUN pip install --no-cache-dir -r /deps/%s\n" % (
+                      base_image, requirements_name, requirements_name, requirements_name)).encode('utf-8')
+    context = io.BytesIO()
+    with tarfile.open(fileobj=context, mode='w') as tar:
+        for name, content in (('Dockerfile', dockerfile), (requirements_name, requirements)):
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = len(content)
+            tar.addfile(tar_info, io.BytesIO(content))
+    context.seek(0)
+    return context
+
+
+def ensure_deps_image(deps_tag, base_image, requirements, requirements_name,
+                      repo_user, repo_password, docker_repo, base_url=None):
+    client = get_client(base_url)
+    full_tag = docker_repo + ":" + deps_tag
+    auth_config = {'username': repo_user, 'password': repo_password}
+    try:
+        client.images.get(full_tag)
+        log.debug("Dependency image %s found on %s", full_tag, base_url)
+        metrics.inc('kubbuilder_image_cache_total', cache='deps', result='local')
+        return full_tag
+    except docker.errors.ImageNotFound:
+        pass
+    try:
+        client.images.pull(docker_repo, tag=deps_tag, auth_config=auth_config)
+        log.debug("Dependency image %s pulled to %s", full_tag, base_url)
+        metrics.inc('kubbuilder_image_cache_total', cache='deps', result='pulled')
+        return full_tag
+    except docker.errors.APIError as e:
+        log.debug("Dependency image %s not in registry, building. Exception: %s", full_tag, e)
+
+    client.images.build(
+        fileobj=deps_build_context(base_image, requirements, requirements_name),
+        custom_context=True,
+        tag=full_tag)
+    for line in client.images.push(repository=docker_repo, tag=deps_tag, auth_config=auth_config,
+                                   stream=True, decode=True):
+        if 'error' in line:
+            raise Exception("Push of %s failed: %s" % (full_tag, line['error']))
+    log.debug("Dependency image %s built and pushed", full_tag)
+    metrics.inc('kubbuilder_image_cache_total', cache='deps', result='built')
+    return full_tag
+
+
+def image_id(full_tag, base_url=None):
+    return get_client(base_url).images.get(full_tag).id
+
+
+def push_image(tag_name, repo_user, repo_password, docker_repo, base_url=None):
+    daemon = get_daemon(base_url or constants.DOCKER_DAEMONS[0])
+    client = daemon['client']
+    # the client keeps the auth config from login, only log in again when the token changed
+    if daemon['logins'].get(docker_repo) != (repo_user, repo_password):
+        client.login(
+            username=repo_user,
+            password=repo_password,
+            registry=docker_repo,
+            email=None,
+            reauth=True)
+        daemon['logins'][docker_repo] = (repo_user, repo_password)
+
+    start = time.time()
+    layers = {}
+    for line in client.images.push(repository=docker_repo, tag=tag_name, stream=True, decode=True):
+        if 'error' in line:
+            raise Exception("Push of %s:%s failed: %s" % (docker_repo, tag_name, line['error']))
+        if 'id' not in line:
+            continue
+        layer = layers.setdefault(line['id'], {'status': None, 'size': 0})
+        layer['status'] = line.get('status')
+        layer['size'] = max(layer['size'], (line.get('progressDetail') or {}).get('total') or 0)
+
+    stats = push_stats(layers)
+    record_push_throughput(stats['pushed_bytes'], time.time() - start)
+    tracing.annotate(bytes=stats['pushed_bytes'], daemon=base_url, image=docker_repo + ":" + tag_name)
+    log.debug("Image %s:%s pushed successful, %s", docker_repo, tag_name, stats)
+    return stats
+
+
+def record_push_throughput(pushed_bytes, elapsed):
+    # moving average of bytes/s over pushes that uploaded something
+    if pushed_bytes <= 0 or elapsed <= 0:
+        return
+    with daemons_lock:
+        current = push_throughput['bytes_per_second']
+        observed = pushed_bytes / elapsed
+        push_throughput['bytes_per_second'] = observed if current is None else 0.8 * current + 0.2 * observed
+
+
+def estimated_push_seconds(size):
+    with daemons_lock:
+        bytes_per_second = push_throughput['bytes_per_second']
+    return round(size / bytes_per_second, 3) if bytes_per_second else None
+
+
+def push_stats(layers):
+    pushed = [l for l in layers.values() if l['status'] == 'Pushed']
+    return {
+        'pushed_bytes': sum(l['size'] for l in pushed),
+        'layers_pushed': len(pushed),
+        'layers_existing': len([l for l in layers.values() if l['status'] == 'Layer already exists'])}
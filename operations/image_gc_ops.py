@@ -0,0 +1,154 @@
+import threading
+import time
+import constants
+import metrics
+import operations.docker_ops as docker_ops
+from coralogger import get_default_logger, RATE_LIMITED
+
+log = get_default_logger()
+
+# Last time an image tag was built or pushed on a daemon, (base_url, full tag) -> time.
+# Images this process hasn't used since it started fall back to their creation time.
+usage_lock = threading.Lock()
+last_used = {}
+
+collector_lock = threading.Lock()
+collector = {'thread': None}
+
+
+def touch(base_url, full_tag):
+    with usage_lock:
+        last_used[(base_url, full_tag)] = time.time()
+
+
+def executor_tag(tag):
+    # executor images are <DOCKER_REPO>:<tag>-<epoch>; anything from another repository,
+    # like the base images, is kept
+    repo, _, name = tag.rpartition(":")
+    return repo == constants.DOCKER_REPO and not name.startswith("deps-")
+
+
+def deps_tag(tag):
+    # dependency images are <DOCKER_REPO>:deps-<hash>, evicted once no kept image is built on them
+    repo, _, name = tag.rpartition(":")
+    return repo == constants.DOCKER_REPO and name.startswith("deps-")
+
+
+def image_last_used(base_url, image):
+    with usage_lock:
+        used = max([last_used.get((base_url, tag), 0) for tag in image['RepoTags']] or [0])
+    return used or image.get('Created', 0)
+
+
+def eviction_candidates(base_url, images):
+    now = time.time()
+    candidates = []
+    for image in images:
+        tags = image.get('RepoTags') or []
+        # untagged images are the daemon's intermediate build cache
+        if not tags or not all(executor_tag(t) or deps_tag(t) for t in tags):
+            continue
+        if image.get('Containers', 0) > 0:
+            continue
+        used = image_last_used(base_url, image)
+        if now - used < constants.IMAGE_GC_MIN_AGE:
+            continue
+        candidates.append((used, image))
+    return [image for used, image in sorted(candidates, key=lambda c: c[0])]
+
+
+def image_layers(client, layers, image_id):
+    # RootFS layer digests by image id, inspected once per collection
+    if image_id not in layers:
+        try:
+            layers[image_id] = client.images.get(image_id).attrs.get('RootFS', {}).get('Layers') or []
+        except Exception as e:
+            log.debug("Image %s not inspected. Exception: %s", image_id, e)
+            layers[image_id] = []
+    return layers[image_id]
+
+
+def has_children(client, layers, image, present):
+    # an image built on another one starts with all of its layers
+    base = image_layers(client, layers, image['Id'])
+    if not base:
+        return False
+    for other in present.values():
+        if other['Id'] != image['Id']:
+            other_layers = image_layers(client, layers, other['Id'])
+            if len(other_layers) > len(base) and other_layers[:len(base)] == base:
+                return True
+    return False
+
+
+def collect(base_url):
+    """
+    Removes least recently used executor images from the daemon once its layers take
+    more than IMAGE_GC_HIGH_WATER_BYTES, until they fit IMAGE_GC_LOW_WATER_BYTES.
+    Dependency images go the same way once no image left on the daemon is built on them.
+    Images are untagged rather than forced out, so layers shared with base, dependency
+    or other executor images stay. Returns the bytes reclaimed.
+    """
+    client = docker_ops.get_client(base_url)
+    usage = client.df()
+    before = usage.get('LayersSize') or 0
+    metrics.set_gauge('kubbuilder_image_disk_bytes', before, daemon=base_url)
+    if before <= constants.IMAGE_GC_HIGH_WATER_BYTES:
+        return 0
+
+    present = dict((image['Id'], image) for image in usage.get('Images') or [])
+    layers = {}
+    expected = before
+    removed = 0
+    candidates = eviction_candidates(base_url, usage.get('Images') or [])
+    # dependency images skipped while their executors were still there get a second
+    # chance once the executors after them in LRU order are gone
+    for attempt in range(2):
+        deferred = []
+        for image in candidates:
+            if expected <= constants.IMAGE_GC_LOW_WATER_BYTES:
+                break
+            if deps_tag(image['RepoTags'][0]) and has_children(client, layers, image, present):
+                deferred.append(image)
+                continue
+            try:
+                for tag in image['RepoTags']:
+                    client.images.remove(tag)
+            except Exception as e:
+                log.debug("Image %s on %s not removed. Exception: %s", image['RepoTags'], base_url, e)
+                continue
+            removed += 1
+            del present[image['Id']]
+            # only the layers no other image uses are freed
+            expected -= image.get('Size', 0) - max(image.get('SharedSize', 0), 0)
+            with usage_lock:
+                for tag in image['RepoTags']:
+                    last_used.pop((base_url, tag), None)
+        if not deferred or len(deferred) == len(candidates):
+            break
+        candidates = deferred
+
+    after = client.df().get('LayersSize') or 0
+    reclaimed = max(before - after, 0)
+    metrics.set_gauge('kubbuilder_image_disk_bytes', after, daemon=base_url)
+    metrics.inc('kubbuilder_image_gc_removed_total', removed, daemon=base_url)
+    metrics.inc('kubbuilder_image_gc_reclaimed_bytes_total', reclaimed, daemon=base_url)
+    log.debug("Image GC on %s removed %s images, %s bytes reclaimed", base_url, removed, reclaimed)
+    return reclaimed
+
+
+def run_collector():
+    while True:
+        for base_url in constants.DOCKER_DAEMONS:
+            try:
+                collect(base_url)
+            except Exception as e:
+                log.debug("Image GC on %s failed. Exception: %s", base_url, e, extra=RATE_LIMITED)
+        time.sleep(constants.IMAGE_GC_INTERVAL)
+
+
+def start_collector():
+    with collector_lock:
+        if collector['thread'] is None:
+            collector['thread'] = threading.Thread(target=run_collector, daemon=True)
+            collector['thread'].start()
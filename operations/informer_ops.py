@@ -0,0 +1,100 @@
+import threading
+import time
+import constants
+import operations.kuber_ops as kuber_ops
+from coralogger import get_default_logger, RATE_LIMITED
+
+log = get_default_logger()
+
+KINDS = ['service', 'deployment', 'hpa', 'ingress', 'secret']
+
+informers_lock = threading.Lock()
+informers = {}
+
+
+def start_informers(namespace):
+    # only the call that starts the informers waits for their first sync: later calls, like a
+    # relisting informer, are served by get() and list_items() reading from the API directly
+    started = []
+    with informers_lock:
+        for kind in KINDS:
+            if (kind, namespace) in informers:
+                continue
+            started.append(kind)
+            informer = {
+                'lock': threading.Lock(),
+                'items': {},
+                'resource_version': None,
+                'synced': threading.Event()}
+            informers[(kind, namespace)] = informer
+            threading.Thread(target=run_informer, args=(kind, namespace, informer), daemon=True).start()
+
+    for kind in started:
+        if not informers[(kind, namespace)]['synced'].wait(constants.INFORMER_SYNC_TIMEOUT):
+            log.error("Informer for %s in %s didn't sync in %ss", kind, namespace, constants.INFORMER_SYNC_TIMEOUT)
+
+
+def run_informer(kind, namespace, informer):
+    while True:
+        try:
+            if informer['resource_version'] is None:
+                resources = kuber_ops.get_resources_list(kind, namespace)
+                with informer['lock']:
+                    informer['items'] = dict((r.metadata.name, r) for r in resources.items)
+                    informer['resource_version'] = resources.metadata.resource_version
+                informer['synced'].set()
+                log.debug("Informer for %s in %s synced %s objects at resourceVersion %s",
+                          kind, namespace, len(resources.items), resources.metadata.resource_version)
+
+            for event in kuber_ops.watch_resources(kind, namespace, informer['resource_version'],
+                                                   constants.INFORMER_WATCH_TIMEOUT):
+                if event['type'] == 'ERROR':
+                    raise Exception("Watch error: %s" % event['object'])
+                apply_event(informer, event['type'], event['object'])
+        except Exception as e:
+            log.debug("Informer for %s in %s relisting. Exception: %s", kind, namespace, e, extra=RATE_LIMITED)
+            with informer['lock']:
+                informer['resource_version'] = None
+            informer['synced'].clear()
+            time.sleep(constants.INFORMER_RETRY_DELAY)
+
+
+def apply_event(informer, event_type, resource):
+    with informer['lock']:
+        if event_type == 'DELETED':
+            informer['items'].pop(resource.metadata.name, None)
+        else:
+            informer['items'][resource.metadata.name] = resource
+        informer['resource_version'] = resource.metadata.resource_version
+
+
+def store(kind, namespace, resource):
+    # makes our own writes visible right away instead of waiting for the watch event
+    informer = informers.get((kind, namespace))
+    if informer is not None and resource is not None:
+        with informer['lock']:
+            informer['items'][resource.metadata.name] = resource
+    return resource
+
+
+def get(kind, name, namespace):
+    informer = informers.get((kind, namespace))
+    if informer is not None and informer['synced'].is_set():
+        with informer['lock']:
+            return informer['items'].get(name)
+
+    log.debug("Informer for %s in %s isn't synced, reading %s from the API", kind, namespace, name,
+              extra=RATE_LIMITED)
+    try:
+        return kuber_ops.read_resource(kind, name, namespace)
+    except Exception as e:
+        log.debug("%s %s doesn't exist. Exception: %s", kind, name, e)
+        return None
+
+
+def list_items(kind, namespace):
+    informer = informers.get((kind, namespace))
+    if informer is not None and informer['synced'].is_set():
+        with informer['lock']:
+            return list(informer['items'].values())
+    return kuber_ops.get_resources_list(kind, namespace).items
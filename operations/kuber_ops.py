@@ -1,4 +1,4 @@
-from kubernetes import client, config
+from kubernetes import client, config, watch
 from coralogger import get_default_logger
 
 log = get_default_logger()
@@ -47,30 +47,29 @@ def create_secret_object(name, variables_dict):
     return secret
 
 
-def create_env_list(secret_name):
+def create_env_list(secret):
     envs_list = []
-    secret = get_nlu_secret(secret_name, namespace="nlu")
-    for k, v in secret.data.items():
+    for k in sorted(secret.data or {}):
         envs_list.append(client.V1EnvVar(
             name=k,
             value_from=client.V1EnvVarSource(
                 secret_key_ref=client.V1SecretKeySelector(
                     key=k,
-                    name=secret_name))))
+                    name=secret.metadata.name))))
     return envs_list
 
 
-def create_nlu_deployment_object(image_full_name, secret_name, tag_name, mem_allocation):
+def create_nlu_deployment_object(image_full_name, secret, tag_name, mem_allocation, mcpu="80m", mem_limit=None):
     memory = str(int(mem_allocation)) + "Mi"
-    mcpu = "80m"
-    if secret_name is not None:
-        env_list = create_env_list(secret_name)
+    memory_limit = str(int(mem_limit or mem_allocation)) + "Mi"
+    if secret is not None:
+        env_list = create_env_list(secret)
     else:
         env_list = [client.V1EnvVar(name="no-nlu-variables", value="true")]
 
     resourse = client.V1ResourceRequirements(
         requests={"memory": memory, "cpu": mcpu},
-        limits={"memory": memory})
+        limits={"memory": memory_limit})
     liveness = client.V1Probe(
         http_get=client.V1HTTPGetAction(
             path="/healthcheck",
@@ -132,7 +131,7 @@ def create_nlu_deployment(deployment, namespace):
     api_response = api_instance.create_namespaced_deployment(
         body=deployment,
         namespace=namespace)
-    log.debug("Deployment created %s. status='%s'" % (deployment.metadata.name, str(api_response.status)))
+    log.debug("Deployment created %s. status='%s'", deployment.metadata.name, str(api_response.status))
     return api_response
 
 
@@ -143,8 +142,8 @@ def replace_nlu_deployment(deployment, image_full_name, namespace, tag_name):
         name=tag_name,
         namespace=namespace,
         body=deployment)
-    log.debug("Deployment updated %s with image %s. status='%s'" % (
-        deployment.metadata.name, image_full_name, str(api_response.status)))
+    log.debug("Deployment updated %s with image %s. status='%s'",
+              deployment.metadata.name, image_full_name, str(api_response.status))
     return api_response
 
 
@@ -156,7 +155,7 @@ def delete_nlu_deployment(tag_name, namespace):
         body=client.V1DeleteOptions(
             propagation_policy='Foreground',
             grace_period_seconds=5))
-    log.debug("Deployment deleted %s. status='%s'" % (tag_name, str(api_response.status)))
+    log.debug("Deployment deleted %s. status='%s'", tag_name, str(api_response.status))
     return api_response
 
 
@@ -185,14 +184,14 @@ def get_nlu_ingress(ingress_name, namespace):
 def create_nlu_ingress(ingress, namespace):
     api_instance = client.ExtensionsV1beta1Api()
     api_response = api_instance.create_namespaced_ingress(namespace=namespace, body=ingress)
-    log.debug("Ingress created %s. status='%s'" % (ingress.metadata.name, str(api_response.status)))
+    log.debug("Ingress created %s. status='%s'", ingress.metadata.name, str(api_response.status))
     return api_response
 
 
 def delete_nlu_ingress(ingress_name, namespace):
     api_instance = client.ExtensionsV1beta1Api()
     api_response = api_instance.delete_namespaced_ingress(name=ingress_name, namespace=namespace)
-    log.debug("Service deleted %s. status='%s'" % (ingress_name, str(api_response.status)))
+    log.debug("Service deleted %s. status='%s'", ingress_name, str(api_response.status))
     return api_response
 
 
@@ -202,7 +201,7 @@ def replace_nlu_ingress(ingress, namespace):
         name=ingress.metadata.name,
         namespace=namespace,
         body=ingress)
-    log.debug("ingress %s replaced. status='%s'" % (ingress.metadata.name, str(api_response.status)))
+    log.debug("ingress %s replaced. status='%s'", ingress.metadata.name, str(api_response.status))
     return api_response
 
 
@@ -219,7 +218,7 @@ def create_nlu_service(service, namespace):
     api_response = api_instance.create_namespaced_service(
         namespace=namespace,
         body=service)
-    log.debug("Service created %s. status='%s'" % (service.metadata.name, str(api_response.status)))
+    log.debug("Service created %s. status='%s'", service.metadata.name, str(api_response.status))
     return api_response
 
 
@@ -228,7 +227,7 @@ def delete_nlu_service(service_name, namespace):
     api_response = api_instance.delete_namespaced_service(
         name=service_name,
         namespace=namespace)
-    log.debug("Service deleted %s. status='%s'" % (service_name, str(api_response.status)))
+    log.debug("Service deleted %s. status='%s'", service_name, str(api_response.status))
     return api_response
 
 
@@ -238,7 +237,7 @@ def patch_nlu_service(service, namespace):
         name=service.metadata.name,
         namespace=namespace,
         body=service)
-    log.debug("Service patched %s. status='%s'" % (service.metadata.name, str(api_response.status)))
+    log.debug("Service patched %s. status='%s'", service.metadata.name, str(api_response.status))
     return api_response
 
 
@@ -248,7 +247,7 @@ def replace_nlu_service(service, namespace):
         name=service.metadata.name,
         namespace=namespace,
         body=service)
-    log.debug("Service replaced %s. status='%s'" % (service.metadata.name, str(api_response.status)))
+    log.debug("Service replaced %s. status='%s'", service.metadata.name, str(api_response.status))
     return api_response
 
 
@@ -265,7 +264,7 @@ def create_nlu_hpa(hpa, namespace):
     api_response = api_instance.create_namespaced_horizontal_pod_autoscaler(
         body=hpa,
         namespace=namespace)
-    log.debug("Horizontal pod autoscaler created %s. status='%s'" % (hpa.metadata.name, str(api_response.status)))
+    log.debug("Horizontal pod autoscaler created %s. status='%s'", hpa.metadata.name, str(api_response.status))
     return api_response
 
 
@@ -274,7 +273,7 @@ def delete_nlu_hpa(hpa_name, namespace):
     api_response = api_instance.delete_namespaced_horizontal_pod_autoscaler(
         name=hpa_name,
         namespace=namespace)
-    log.debug("Horizontal pod autoscaler deleted %s. status='%s'" % (hpa_name, str(api_response.status)))
+    log.debug("Horizontal pod autoscaler deleted %s. status='%s'", hpa_name, str(api_response.status))
     return api_response
 
 
@@ -284,7 +283,7 @@ def replace_nlu_hpa(hpa, namespace):
         name=hpa.metadata.name,
         namespace=namespace,
         body=hpa)
-    log.debug("Horizontal pod autoscaler replaced %s. status='%s'" % (hpa.metadata.name, str(api_response.status)))
+    log.debug("Horizontal pod autoscaler replaced %s. status='%s'", hpa.metadata.name, str(api_response.status))
     return api_response
 
 
@@ -293,7 +292,7 @@ def create_secret(secret, namespace):
     api_response = api_instance.create_namespaced_secret(
         namespace=namespace,
         body=secret)
-    log.debug("Secret created %s. status='%s'" % (secret.metadata.name, str(api_response.metadata.name)))
+    log.debug("Secret created %s. status='%s'", secret.metadata.name, str(api_response.metadata.name))
     return api_response
 
 
@@ -302,7 +301,7 @@ def delete_secret(secret_name, namespace):
     api_response = api_instance.delete_namespaced_secret(
         namespace=namespace,
         name=secret_name)
-    log.debug("Secret deleted %s. status='%s'" % (secret_name, str(api_response.metadata.name)))
+    log.debug("Secret deleted %s. status='%s'", secret_name, str(api_response.metadata.name))
     return api_response
 
 
@@ -312,7 +311,7 @@ def update_secret(secret, namespace):
         namespace=namespace,
         name=secret.metadata.name,
         body=secret)
-    log.debug("Secret updated %s. status='%s'" % (secret.metadata.name, str(api_response.data)))
+    log.debug("Secret updated %s. status='%s'", secret.metadata.name, str(api_response.data))
     return api_response
 
 
@@ -351,3 +350,157 @@ def get_deployment_status(namespace, deployment_name):
     deploy_status = api_instance.read_namespaced_deployment_status(name=deployment_name,
                                                                    namespace=namespace)
     return deploy_status
+
+
+def list_pods(namespace, label_selector):
+    api_instance = client.CoreV1Api()
+    pods_list = api_instance.list_namespaced_pod(namespace=namespace, label_selector=label_selector)
+    return pods_list
+
+
+def watch_pods(namespace, label_selector, resource_version, timeout_seconds):
+    api_instance = client.CoreV1Api()
+    return watch.Watch().stream(
+        api_instance.list_namespaced_pod,
+        namespace=namespace,
+        label_selector=label_selector,
+        resource_version=resource_version,
+        timeout_seconds=timeout_seconds)
+
+
+def list_resources_method(kind):
+    if kind == 'service':
+        return client.CoreV1Api().list_namespaced_service
+    if kind == 'deployment':
+        return client.ExtensionsV1beta1Api().list_namespaced_deployment
+    if kind == 'hpa':
+        return client.AutoscalingV1Api().list_namespaced_horizontal_pod_autoscaler
+    if kind == 'ingress':
+        return client.ExtensionsV1beta1Api().list_namespaced_ingress
+    if kind == 'secret':
+        return client.CoreV1Api().list_namespaced_secret
+    raise ValueError("Unknown resource kind %s" % kind)
+
+
+def get_resources_list(kind, namespace):
+    return list_resources_method(kind)(namespace=namespace)
+
+
+def watch_resources(kind, namespace, resource_version, timeout_seconds):
+    return watch.Watch().stream(
+        list_resources_method(kind),
+        namespace=namespace,
+        resource_version=resource_version,
+        timeout_seconds=timeout_seconds)
+
+
+def read_resource(kind, name, namespace):
+    if kind == 'service':
+        return get_nlu_service(name, namespace)
+    if kind == 'deployment':
+        return get_nlu_deployment(name, namespace)
+    if kind == 'hpa':
+        return get_nlu_hpa(name, namespace)
+    if kind == 'ingress':
+        return get_nlu_ingress(name, namespace)
+    if kind == 'secret':
+        return get_nlu_secret(name, namespace)
+    raise ValueError("Unknown resource kind %s" % kind)
+
+
+def serialize(resource):
+    return client.ApiClient().sanitize_for_serialization(resource)
+
+
+def create_resource(kind, resource, namespace):
+    if kind == 'service':
+        return create_nlu_service(resource, namespace)
+    if kind == 'deployment':
+        return create_nlu_deployment(resource, namespace)
+    if kind == 'hpa':
+        return create_nlu_hpa(resource, namespace)
+    if kind == 'ingress':
+        return create_nlu_ingress(resource, namespace)
+    if kind == 'secret':
+        return create_secret(resource, namespace)
+    raise ValueError("Unknown resource kind %s" % kind)
+
+
+def patch_resource(kind, name, namespace, body):
+    # a dict body is sent as a strategic merge patch
+    if kind == 'service':
+        api_response = client.CoreV1Api().patch_namespaced_service(name=name, namespace=namespace, body=body)
+    elif kind == 'deployment':
+        api_response = client.ExtensionsV1beta1Api().patch_namespaced_deployment(
+            name=name, namespace=namespace, body=body)
+    elif kind == 'hpa':
+        api_response = client.AutoscalingV1Api().patch_namespaced_horizontal_pod_autoscaler(
+            name=name, namespace=namespace, body=body)
+    elif kind == 'ingress':
+        api_response = client.ExtensionsV1beta1Api().patch_namespaced_ingress(
+            name=name, namespace=namespace, body=body)
+    elif kind == 'secret':
+        api_response = client.CoreV1Api().patch_namespaced_secret(name=name, namespace=namespace, body=body)
+    else:
+        raise ValueError("Unknown resource kind %s" % kind)
+    log.debug("%s %s patched", kind, name)
+    return api_response
+
+
+def create_prepull_daemon_set_object(name, image_full_name, node_selector, pause_image):
+    # the executor image runs as an init container that exits right away, so every node
+    # pulls it while the pod itself only keeps the small pause image running
+    pull = client.V1Container(
+        name="pull",
+        image=image_full_name,
+        image_pull_policy="IfNotPresent",
+        command=["sh", "-c", "exit 0"])
+    pause = client.V1Container(
+        name="pause",
+        image=pause_image,
+        resources=client.V1ResourceRequirements(requests={"cpu": "1m", "memory": "8Mi"}))
+    template = client.V1PodTemplateSpec(
+        metadata=client.V1ObjectMeta(labels={"prepull": name}),
+        spec=client.V1PodSpec(
+            init_containers=[pull],
+            containers=[pause],
+            node_selector=node_selector or None,
+            termination_grace_period_seconds=0))
+    daemon_set = client.V1beta1DaemonSet(
+        api_version="extensions/v1beta1",
+        kind="DaemonSet",
+        metadata=client.V1ObjectMeta(name=name, labels={"prepull": name}),
+        spec=client.V1beta1DaemonSetSpec(template=template))
+    return daemon_set
+
+
+def create_daemon_set(daemon_set, namespace):
+    api_instance = client.ExtensionsV1beta1Api()
+    api_response = api_instance.create_namespaced_daemon_set(namespace=namespace, body=daemon_set)
+    log.debug("DaemonSet created %s", daemon_set.metadata.name)
+    return api_response
+
+
+def get_daemon_set(name, namespace):
+    api_instance = client.ExtensionsV1beta1Api()
+    return api_instance.read_namespaced_daemon_set(name=name, namespace=namespace)
+
+
+def delete_daemon_set(name, namespace):
+    api_instance = client.ExtensionsV1beta1Api()
+    api_response = api_instance.delete_namespaced_daemon_set(
+        name=name,
+        namespace=namespace,
+        body=client.V1DeleteOptions(propagation_policy='Background', grace_period_seconds=0))
+    log.debug("DaemonSet deleted %s", name)
+    return api_response
+
+
+def get_pod_metrics(namespace):
+    api_instance = client.CustomObjectsApi()
+    pod_metrics = api_instance.list_namespaced_custom_object(
+        group="metrics.k8s.io",
+        version="v1beta1",
+        namespace=namespace,
+        plural="pods")
+    return pod_metrics
@@ -0,0 +1,125 @@
+import threading
+import time
+import constants
+import metrics
+import operations.kuber_ops as kuber_ops
+from coralogger import get_default_logger, RATE_LIMITED
+
+log = get_default_logger()
+
+# guards the progress dicts start_prepull hands out, which results and /jobs read while they change
+prepull_lock = threading.Lock()
+
+
+def daemon_set_name(tag):
+    # DaemonSet names and label values are limited to 63 characters
+    return ("prepull-" + tag)[:63].rstrip("-")
+
+
+def node_selector():
+    # PREPULL_NODE_SELECTOR is "key=value,key=value"
+    pairs = [p.split("=", 1) for p in constants.PREPULL_NODE_SELECTOR.split(",") if "=" in p]
+    return dict((k.strip(), v.strip()) for k, v in pairs)
+
+
+def start_prepull(tag, image_full_name, namespace):
+    """
+    Starts warming the image on the candidate nodes in the background and returns the
+    dict its progress is recorded in: 'status' and 'nodes' (node -> pull seconds)
+    """
+    prepull = {'status': 'running', 'nodes': {}}
+    threading.Thread(target=run_prepull, args=(tag, image_full_name, namespace, prepull), daemon=True).start()
+    return prepull
+
+
+def snapshot(prepull):
+    # a copy for results, which are serialized while the pre-pull may still be running
+    if prepull is None:
+        return None
+    with prepull_lock:
+        return dict(prepull, nodes=dict(prepull['nodes']))
+
+
+def run_prepull(tag, image_full_name, namespace, prepull):
+    name = daemon_set_name(tag)
+    start = time.time()
+    status = 'failed'
+    try:
+        try:
+            kuber_ops.delete_daemon_set(name, namespace)
+        except Exception:
+            # left over from an earlier job of the executor, usually absent
+            pass
+        kuber_ops.create_daemon_set(
+            kuber_ops.create_prepull_daemon_set_object(
+                name, image_full_name, node_selector(), constants.PREPULL_PAUSE_IMAGE),
+            namespace)
+        status = wait_for_pulls(name, namespace, prepull['nodes'], start + constants.PREPULL_TIMEOUT)
+    except Exception as e:
+        log.debug("Pre-pull of %s failed. Exception: %s", image_full_name, e)
+    finally:
+        with prepull_lock:
+            prepull['status'] = status
+            prepull['seconds'] = round(time.time() - start, 3)
+        try:
+            kuber_ops.delete_daemon_set(name, namespace)
+        except Exception as e:
+            log.debug("DaemonSet %s not deleted. Exception: %s", name, e)
+    log.debug("Pre-pull of %s %s in %ss: %s", image_full_name, prepull['status'], prepull['seconds'], prepull['nodes'])
+
+
+def wait_for_pulls(name, namespace, nodes, deadline):
+    # the DaemonSet's desired count is read once per list or watch, watches last at most
+    # PREPULL_STATUS_INTERVAL so the count is picked up once the controller computed it
+    label_selector = "prepull=" + name
+    events = None
+    resource_version = None
+    failures = 0
+    while time.time() < deadline:
+        try:
+            desired = kuber_ops.get_daemon_set(name, namespace).status.desired_number_scheduled or 0
+            if events is None:
+                pods = kuber_ops.list_pods(namespace, label_selector)
+                resource_version = pods.metadata.resource_version
+                events = [{'type': 'ADDED', 'object': pod, 'listed': True} for pod in pods.items]
+            for event in events:
+                if event['type'] == 'ERROR':
+                    raise Exception("Watch error: %s" % event['object'])
+                pod = event['object']
+                if not event.get('listed'):
+                    resource_version = pod.metadata.resource_version
+                    failures = 0
+                seconds = pull_seconds(pod)
+                if seconds is not None and pod.spec.node_name not in nodes:
+                    with prepull_lock:
+                        nodes[pod.spec.node_name] = seconds
+                    metrics.observe('kubbuilder_phase_duration_seconds', seconds, phase='prepull')
+                if desired and len(nodes) >= desired:
+                    return 'done'
+            if desired and len(nodes) >= desired:
+                return 'done'
+        except Exception as e:
+            log.debug("Watch for %s interrupted, relisting. Exception: %s", name, e, extra=RATE_LIMITED)
+            events = None
+            time.sleep(max(min(constants.READINESS_RETRY_DELAY * 2 ** failures, constants.READINESS_RETRY_MAX_DELAY,
+                               deadline - time.time()), 0))
+            failures += 1
+            continue
+        events = kuber_ops.watch_pods(namespace, label_selector, resource_version,
+                                      max(min(int(deadline - time.time()) + 1, constants.PREPULL_STATUS_INTERVAL), 1))
+    return 'timeout'
+
+
+def pull_seconds(pod):
+    # the pull init container starts once its image is on the node: the time from the
+    # kubelet taking the pod to that start is the pull
+    for status in pod.status.init_container_statuses or []:
+        state = status.state
+        started = None
+        if state is not None and state.terminated is not None:
+            started = state.terminated.started_at
+        elif state is not None and state.running is not None:
+            started = state.running.started_at
+        if started is not None and pod.status.start_time is not None:
+            return round(max((started - pod.status.start_time).total_seconds(), 0), 3)
+    return None
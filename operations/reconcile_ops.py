@@ -0,0 +1,154 @@
+import re
+from decimal import Decimal, InvalidOperation
+import constants
+import operations.kuber_ops as kuber_ops
+from coralogger import get_default_logger
+
+log = get_default_logger()
+
+TOP_LEVEL_SKIPPED = ['apiVersion', 'kind', 'status']
+
+
+# Lists the API server merges by key in a strategic merge patch, with the keys tried in order
+# (ports are keyed by containerPort in pods and by port in services). Any other list is
+# replaced as a whole by the patch.
+MERGE_KEYS = {
+    'containers': ['name'],
+    'initContainers': ['name'],
+    'env': ['name'],
+    'volumes': ['name'],
+    'volumeMounts': ['mountPath'],
+    'ports': ['containerPort', 'port']}
+
+# Maps whose keys all come from the desired object: keys only live has are removed
+OWNED_MAPS = ['labels', 'annotations']
+
+# Maps of resource quantities, which the API server returns in canonical form ("1024Mi" as "1Gi")
+QUANTITY_MAPS = ['requests', 'limits']
+
+QUANTITY_SUFFIXES = {
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60,
+    'n': Decimal('1e-9'), 'u': Decimal('1e-6'), 'm': Decimal('1e-3'), '': 1,
+    'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12, 'P': 10 ** 15, 'E': 10 ** 18}
+QUANTITY_PATTERN = re.compile(r'^([+-]?[0-9.]+(?:[eE][+-]?[0-9]+)?)(Ki|Mi|Gi|Ti|Pi|Ei|n|u|m|k|M|G|T|P|E|)$')
+
+
+def diff(desired, live, field=None):
+    # Returns the smallest strategic merge patch turning live into desired, None when
+    # live already matches. Fields only present in live (server defaults, status) are
+    # left alone, except members of keyed lists and keys of OWNED_MAPS that desired dropped.
+    if isinstance(desired, dict):
+        if not isinstance(live, dict):
+            return desired
+        patch = {}
+        for key, value in desired.items():
+            if field in QUANTITY_MAPS and same_quantity(value, live.get(key)):
+                continue
+            change = diff(value, live.get(key), key)
+            if change is not None:
+                patch[key] = change
+        if field in OWNED_MAPS:
+            for key in live:
+                if key not in desired:
+                    patch[key] = None
+        return patch or None
+
+    if isinstance(desired, list):
+        if not isinstance(live, list):
+            return desired
+        key = merge_key(field, desired)
+        if key is not None and merge_key(field, live) == key:
+            return diff_keyed_list(desired, live, key)
+        if len(desired) == len(live) and all(diff(d, l) is None for d, l in zip(desired, live)):
+            return None
+        return desired
+
+    return None if same_scalar(desired, live) else desired
+
+
+def same_scalar(desired, live):
+    # int-or-string fields (ports, targetPort, servicePort) are typed str by the client's
+    # models, so a desired 5000 comes back from the API as "5000"
+    if desired == live:
+        return True
+    if isinstance(desired, bool) or isinstance(live, bool):
+        return False
+    if isinstance(desired, int) != isinstance(live, int):
+        return str(desired) == str(live)
+    return False
+
+
+def parse_quantity(value):
+    match = QUANTITY_PATTERN.match(str(value).strip())
+    if match is None:
+        return None
+    try:
+        return Decimal(match.group(1)) * QUANTITY_SUFFIXES[match.group(2)]
+    except InvalidOperation:
+        return None
+
+
+def same_quantity(desired, live):
+    desired_quantity = parse_quantity(desired)
+    return desired_quantity is not None and desired_quantity == parse_quantity(live)
+
+
+def merge_key(field, items):
+    for key in MERGE_KEYS.get(field, []):
+        if all(isinstance(i, dict) and key in i for i in items):
+            return key
+    return None
+
+
+def diff_keyed_list(desired, live, key):
+    # members are matched by key, so the same members in another order are no change
+    live_by_key = dict((i[key], i) for i in live)
+    desired_keys = set(i[key] for i in desired)
+    if any(k not in desired_keys for k in live_by_key):
+        # a merge would keep the dropped members: replace the whole list
+        return desired + [{'$patch': 'replace'}]
+    changed = []
+    for item in desired:
+        if item[key] not in live_by_key:
+            changed.append(item)
+            continue
+        change = diff(item, live_by_key[item[key]])
+        if change is not None:
+            change[key] = item[key]
+            changed.append(change)
+    return changed or None
+
+
+def drop_field(resource_dict, path):
+    for key in path[:-1]:
+        resource_dict = resource_dict.get(key)
+        if not isinstance(resource_dict, dict):
+            return
+    resource_dict.pop(path[-1], None)
+
+
+def resource_patch(kind, desired, live):
+    desired_dict = kuber_ops.serialize(desired)
+    live_dict = kuber_ops.serialize(live)
+    for key in TOP_LEVEL_SKIPPED:
+        desired_dict.pop(key, None)
+    for path in constants.RECONCILE_IGNORED_FIELDS.get(kind, []):
+        drop_field(desired_dict, path)
+    return diff(desired_dict, live_dict)
+
+
+def reconcile(kind, desired, live, namespace, stats):
+    name = desired.metadata.name
+    if live is None:
+        stats['writes'] += 1
+        return kuber_ops.create_resource(kind, desired, namespace)
+
+    patch = resource_patch(kind, desired, live)
+    if patch is None:
+        stats['skipped'] += 1
+        log.debug("%s %s is up to date, skipping write", kind, name)
+        return live
+
+    stats['writes'] += 1
+    log.debug("%s %s differs, patching: %s", kind, name, patch)
+    return kuber_ops.patch_resource(kind, name, namespace, patch)
@@ -1,42 +1,213 @@
 import os
+import hashlib
+import io
 import shutil
+import tarfile
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import constants
 from coralogger import get_default_logger
 
 log = get_default_logger()
 
+# Shared by every job's extraction, so concurrent builds together stay within UNZIP_WORKERS.
+# zlib inflates and computes CRCs with the GIL released, so threads extract in parallel.
+unzip_pool = ThreadPoolExecutor(constants.UNZIP_WORKERS)
+
 
 def check_clean_path(local_path, tag):
     if not os.path.exists(local_path):
         os.makedirs(local_path)
-        log.debug("%s doesn't exist, creating" % str(local_path))
+        log.debug("%s doesn't exist, creating", str(local_path))
     full_path = local_path + "/" + tag
 
     if not os.path.exists(full_path):
         os.makedirs(full_path)
-        log.debug("%s doesn't exist, creating" % str(full_path))
+        log.debug("%s doesn't exist, creating", str(full_path))
     else:
         shutil.rmtree(full_path)
-        log.debug("cleaning %s" % str(full_path))
+        log.debug("cleaning %s", str(full_path))
         os.makedirs(full_path)
-        log.debug("%s doesn't exist, creating" % str(full_path))
+        log.debug("%s doesn't exist, creating", str(full_path))
 
 
-def unzip_file(local_path, full_file_path, tag):
-    full_path = local_path + "/" + tag
-    zip_ref = zipfile.ZipFile(full_file_path, 'r')
-    zip_ref.extractall(full_path)
-    if os.path.exists(full_path+"/Dockerfile.nlu"):
-        log.debug("%s dockerfile exist" % str(tag))
+def archive_members(full_file_path, full_path):
+    # file members with a safe name, the directories are created under full_path right away
+    with zipfile.ZipFile(full_file_path, 'r') as zip_ref:
+        infos = zip_ref.infolist()
+
+    members = []
+    for info in infos:
+        if safe_member_name(info.filename) is None:
+            log.debug("%s skipping unsafe entry %s", full_file_path, info.filename)
+        elif info.filename.endswith("/"):
+            os.makedirs(os.path.join(full_path, info.filename), exist_ok=True)
+        else:
+            members.append(info)
+    return members
+
+
+def extract_archive(full_file_path, full_path, members):
+    """
+    Writes the members under full_path, spread over UNZIP_WORKERS threads by
+    compressed size and streamed in UNZIP_CHUNK_SIZE chunks. Returns (bytes, workers).
+    """
+    compressed = sum(info.compress_size for info in members)
+    workers = max(1, min(constants.UNZIP_WORKERS, len(members)))
+    if compressed < constants.UNZIP_PARALLEL_MIN_SIZE:
+        workers = 1
+
+    groups = split_members(members, workers)
+    if workers == 1:
+        written = [extract_members(full_file_path, full_path, groups[0])]
     else:
-        log.debug("%s fail during unziping" % str(tag))
-    zip_ref.close()
-    os.remove(full_file_path)
+        written = list(unzip_pool.map(extract_members, [full_file_path] * workers, [full_path] * workers, groups))
+    return sum(written), workers
+
+
+def extraction_stats(tag, size, files, workers, start):
+    elapsed = time.time() - start
+    log.debug("%s extracted %s files, %s bytes in %.2fs (%.2f MB/s, %s workers)",
+              tag, files, size, elapsed, size / (1024 * 1024) / max(elapsed, 0.001), workers)
+    return {'bytes': size, 'files': files, 'workers': workers, 'seconds': round(elapsed, 3)}
 
 
-def get_training_data_size(full_path, files_list):
+def safe_member_name(name):
+    # zip-slip: absolute names and names climbing out of the target are rejected
+    if name.startswith("/") or ".." in name.split("/"):
+        return None
+    return name
+
+
+def split_members(members, workers):
+    # largest first onto the least loaded worker, so one big model file doesn't end up
+    # behind a pile of others
+    groups = [[] for i in range(workers)]
+    loads = [0] * workers
+    for info in sorted(members, key=lambda i: i.compress_size, reverse=True):
+        least = loads.index(min(loads))
+        groups[least].append(info.filename)
+        loads[least] += info.compress_size
+    return groups
+
+
+def extract_members(full_file_path, full_path, names):
+    # Runs on the unzip pool, with its own handle on the archive. Reading each member to its end makes ZipExtFile
+    # check the CRC-32 and raise BadZipFile on a mismatch.
+    written = 0
+    with zipfile.ZipFile(full_file_path, 'r') as zip_ref:
+        for name in names:
+            target = os.path.join(full_path, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with zip_ref.open(name) as member, open(target, 'wb') as f:
+                while True:
+                    chunk = member.read(constants.UNZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    written += len(chunk)
+    return written
+
+
+def get_archive_data_size(full_file_path, files_list):
     size = 0
-    for i in files_list:
-        path = full_path + "/" + i
-        size += os.path.getsize(path)
+    with zipfile.ZipFile(full_file_path, 'r') as zip_ref:
+        for i in files_list:
+            size += zip_ref.getinfo(i).file_size
     return size
+
+
+def get_archive_digest(full_file_path):
+    # Digest of the names and the sha256 of each member's contents, streamed from the
+    # archive: ignores zip timestamps and compression settings
+    sha = hashlib.sha256()
+    with zipfile.ZipFile(full_file_path, 'r') as zip_ref:
+        for info in sorted(zip_ref.infolist(), key=lambda i: i.filename):
+            content = hashlib.sha256()
+            with zip_ref.open(info) as member:
+                while True:
+                    chunk = member.read(constants.UNZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    content.update(chunk)
+            sha.update(("%s\0%s\n" % (info.filename, content.hexdigest())).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def get_archive_uncompressed_size(full_file_path):
+    with zipfile.ZipFile(full_file_path, 'r') as zip_ref:
+        return sum(info.file_size for info in zip_ref.infolist())
+
+
+def read_archive_files(full_file_path, files_list):
+    contents = {}
+    with zipfile.ZipFile(full_file_path, 'r') as zip_ref:
+        names = zip_ref.namelist()
+        for i in files_list:
+            if i in names:
+                contents[i] = zip_ref.read(i)
+    return contents
+
+
+def write_files(full_path, files_dict):
+    for name, content in files_dict.items():
+        with open(full_path + "/" + name, 'wb') as f:
+            f.write(content)
+
+
+def zip_to_tar_stream(full_file_path, overrides=None):
+    """
+    Returns (stream, writer): the archive as a tar stream written by a background
+    thread, and {'thread', 'error'} to join once the stream was consumed. An error
+    means the stream ended early and the tar is incomplete.
+    """
+    read_fd, write_fd = os.pipe()
+    writer = {'thread': None, 'error': None}
+    writer['thread'] = threading.Thread(target=write_tar_stream, daemon=True,
+                                        args=(full_file_path, write_fd, overrides or {}, writer))
+    writer['thread'].start()
+    return os.fdopen(read_fd, 'rb'), writer
+
+
+def write_tar_stream(full_file_path, write_fd, overrides, writer):
+    try:
+        with os.fdopen(write_fd, 'wb') as output, \
+                zipfile.ZipFile(full_file_path, 'r') as zip_ref, \
+                tarfile.open(fileobj=output, mode='w|') as tar:
+            for info in zip_ref.infolist():
+                tar_info = zip_info_to_tar_info(info)
+                if tar_info is None:
+                    log.debug("%s skipping unsafe entry %s", full_file_path, info.filename)
+                    continue
+                if tar_info.isdir():
+                    tar.addfile(tar_info)
+                elif info.filename in overrides:
+                    tar_info.size = len(overrides[info.filename])
+                    tar.addfile(tar_info, io.BytesIO(overrides[info.filename]))
+                else:
+                    with zip_ref.open(info) as member:
+                        tar.addfile(tar_info, member)
+    except BrokenPipeError as e:
+        log.debug("%s build context reader closed early", str(full_file_path))
+        writer['error'] = e
+    except Exception as e:
+        log.error("%s fail during streaming build context: %s", str(full_file_path), e)
+        writer['error'] = e
+
+
+def zip_info_to_tar_info(info):
+    name = info.filename
+    if safe_member_name(name) is None:
+        return None
+    tar_info = tarfile.TarInfo(name.rstrip("/"))
+    tar_info.mtime = time.mktime(info.date_time + (0, 0, -1))
+    mode = info.external_attr >> 16
+    if name.endswith("/"):
+        tar_info.type = tarfile.DIRTYPE
+        tar_info.mode = mode & 0o7777 or 0o755
+    else:
+        tar_info.size = info.file_size
+        tar_info.mode = mode & 0o7777 or 0o644
+    return tar_info
@@ -0,0 +1,193 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import constants
+import operations.kuber_ops as kuber_ops
+from coralogger import get_default_logger, RATE_LIMITED
+
+log = get_default_logger()
+
+db_lock = threading.Lock()
+sampler_lock = threading.Lock()
+sampler = {'thread': None}
+
+MEMORY_UNITS = {'Ki': 1024, 'Mi': 1024 ** 2, 'Gi': 1024 ** 3, 'Ti': 1024 ** 4,
+                'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4, '': 1}
+CPU_UNITS = {'n': 1e-6, 'u': 1e-3, 'm': 1, '': 1000}
+
+
+def connect(db_file):
+    os.makedirs(os.path.dirname(db_file), exist_ok=True)
+    connection = sqlite3.connect(db_file)
+    connection.execute("CREATE TABLE IF NOT EXISTS observations ("
+                       "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                       "tag TEXT NOT NULL, "
+                       "training_size INTEGER NOT NULL, "
+                       "archive_size INTEGER NOT NULL, "
+                       "deployed_at REAL NOT NULL, "
+                       "peak_memory_mi REAL, "
+                       "peak_cpu_m REAL)")
+    return connection
+
+
+def parse_memory_mi(quantity):
+    match = re.match(r'^([0-9.]+)([A-Za-z]*)$', quantity)
+    return float(match.group(1)) * MEMORY_UNITS[match.group(2)] / 1024 ** 2
+
+
+def parse_cpu_m(quantity):
+    match = re.match(r'^([0-9.]+)([a-z]?)$', quantity)
+    return float(match.group(1)) * CPU_UNITS[match.group(2)]
+
+
+def record_deployment(db_file, tag, features):
+    """
+    Starts a new observation for the tag, peaks are filled in by the sampler
+    """
+    with db_lock:
+        connection = connect(db_file)
+        with connection:
+            connection.execute(
+                "INSERT INTO observations (tag, training_size, archive_size, deployed_at) VALUES (?, ?, ?, ?)",
+                (tag, features['training_size'], features['archive_size'], time.time()))
+        connection.close()
+
+
+def record_usage(db_file, usage):
+    """
+    usage maps tag to (memory Mi, cpu m) of its busiest pod, kept as the peak of the latest deployment
+    """
+    with db_lock:
+        connection = connect(db_file)
+        with connection:
+            for tag, (memory, cpu) in usage.items():
+                connection.execute(
+                    "UPDATE observations SET "
+                    "peak_memory_mi = MAX(COALESCE(peak_memory_mi, 0), ?), "
+                    "peak_cpu_m = MAX(COALESCE(peak_cpu_m, 0), ?) "
+                    "WHERE id = (SELECT MAX(id) FROM observations WHERE tag = ?)",
+                    (memory, cpu, tag))
+        connection.close()
+
+
+def load_observations(db_file):
+    with db_lock:
+        connection = connect(db_file)
+        rows = connection.execute(
+            "SELECT training_size, archive_size, peak_memory_mi, peak_cpu_m FROM observations "
+            "WHERE peak_memory_mi IS NOT NULL ORDER BY id DESC LIMIT ?",
+            (constants.SIZING_HISTORY_SIZE,)).fetchall()
+        connection.close()
+    return rows
+
+
+def solve(matrix, vector):
+    # Gaussian elimination with partial pivoting, the systems here are 3x3
+    n = len(vector)
+    a = [list(row) + [v] for row, v in zip(matrix, vector)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        if abs(a[pivot][col]) < 1e-12:
+            return None
+        a[col], a[pivot] = a[pivot], a[col]
+        for r in range(col + 1, n):
+            factor = a[r][col] / a[col][col]
+            for c in range(col, n + 1):
+                a[r][c] -= factor * a[col][c]
+    x = [0.0] * n
+    for r in reversed(range(n)):
+        x[r] = (a[r][n] - sum(a[r][c] * x[c] for c in range(r + 1, n))) / a[r][r]
+    return x
+
+
+def fit(samples, targets):
+    """
+    Least squares fit of target = b0 + b1 * training_size + b2 * archive_size
+    """
+    rows = [[1.0, float(t), float(a)] for t, a in samples]
+    xtx = [[sum(r[i] * r[j] for r in rows) for j in range(3)] for i in range(3)]
+    xty = [sum(r[i] * y for r, y in zip(rows, targets)) for i in range(3)]
+    coefficients = solve(xtx, xty)
+    if coefficients is None:
+        # features don't vary enough for three terms, fall back to the training data size alone
+        xtx = [[len(rows), sum(r[1] for r in rows)], [sum(r[1] for r in rows), sum(r[1] ** 2 for r in rows)]]
+        xty = [sum(targets), sum(r[1] * y for r, y in zip(rows, targets))]
+        coefficients = solve(xtx, xty)
+        if coefficients is None:
+            coefficients = [sum(targets) / len(targets), 0.0]
+        coefficients.append(0.0)
+    return coefficients
+
+
+def predict(coefficients, features):
+    return coefficients[0] + coefficients[1] * features['training_size'] + coefficients[2] * features['archive_size']
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def fallback_sizing(features):
+    memory = (constants.MALLOCATION_COEFICIENT * features['training_size'] + constants.MALLOCATION_CONSTANT) * \
+        constants.MALLOCATION_ALLOWANCE
+    return {'memory': memory, 'memory_limit': memory, 'cpu': constants.SIZING_DEFAULT_CPU, 'model': 'formula'}
+
+
+def recommend(db_file, features):
+    """
+    Memory and cpu requests/limits for an executor with the given archive features:
+    a regression over observed peaks plus the SIZING_PERCENTILE of its residuals,
+    or the fixed formula until there is enough history
+    """
+    rows = load_observations(db_file)
+    if len(rows) < constants.SIZING_MIN_OBSERVATIONS:
+        return fallback_sizing(features)
+
+    samples = [(r[0], r[1]) for r in rows]
+    memory_peaks = [r[2] for r in rows]
+    cpu_peaks = [r[3] or 0 for r in rows]
+
+    coefficients = fit(samples, memory_peaks)
+    residuals = [peak - predict(coefficients, dict(training_size=t, archive_size=a))
+                 for (t, a), peak in zip(samples, memory_peaks)]
+    memory = max(predict(coefficients, features) + max(percentile(residuals, constants.SIZING_PERCENTILE), 0),
+                 constants.SIZING_MIN_MEMORY)
+    memory *= constants.SIZING_MEMORY_HEADROOM
+    cpu = max(percentile(cpu_peaks, constants.SIZING_PERCENTILE), constants.SIZING_MIN_CPU)
+
+    return {'memory': memory,
+            'memory_limit': memory * constants.SIZING_LIMIT_FACTOR,
+            'cpu': str(int(cpu)) + "m",
+            'model': 'observed'}
+
+
+def sample_usage(namespace):
+    usage = {}
+    for pod in kuber_ops.get_pod_metrics(namespace).get('items', []):
+        tag = (pod['metadata'].get('labels') or {}).get('app')
+        if tag is None:
+            continue
+        memory = sum(parse_memory_mi(c['usage']['memory']) for c in pod['containers'])
+        cpu = sum(parse_cpu_m(c['usage']['cpu']) for c in pod['containers'])
+        previous = usage.get(tag, (0, 0))
+        usage[tag] = (max(previous[0], memory), max(previous[1], cpu))
+    return usage
+
+
+def run_sampler(db_file, namespace):
+    while True:
+        try:
+            record_usage(db_file, sample_usage(namespace))
+        except Exception as e:
+            log.debug("Pod metrics sampling failed. Exception: %s", e, extra=RATE_LIMITED)
+        time.sleep(constants.SIZING_SAMPLE_INTERVAL)
+
+
+def start_sampler(db_file, namespace):
+    with sampler_lock:
+        if sampler['thread'] is None:
+            sampler['thread'] = threading.Thread(target=run_sampler, args=(db_file, namespace), daemon=True)
+            sampler['thread'].start()
@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import threading
+import time
+import constants
+import operations.simple_ops as simple_ops
+from coralogger import get_default_logger
+
+log = get_default_logger()
+
+# Extracted executors are kept under local_path/<tag> between builds, with a manifest of
+# name -> [size, crc] per tag so a new archive only rewrites the entries that changed
+workspace_lock = threading.Lock()
+in_use = set()
+
+
+def manifest_file(tag):
+    return os.path.join(constants.WORKSPACE_MANIFEST_DIR, tag + ".json")
+
+
+def load_manifest(tag):
+    path = manifest_file(tag)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError as e:
+        log.error("Workspace manifest %s is corrupted, re-extracting. Exception: %s", path, e)
+        return None
+
+
+def save_manifest(tag, manifest):
+    path = manifest_file(tag)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = path + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, path)
+
+
+def remove_manifest(tag):
+    try:
+        os.remove(manifest_file(tag))
+    except FileNotFoundError:
+        pass
+
+
+def acquire(tag):
+    # a workspace being synced or built from is never evicted
+    with workspace_lock:
+        in_use.add(tag)
+
+
+def release(tag):
+    with workspace_lock:
+        in_use.discard(tag)
+
+
+def unchanged(full_path, entry, info):
+    # the file on disk is only trusted while it still has the size the manifest recorded
+    if entry is None or entry[1] is None or entry != [info.file_size, info.CRC]:
+        return False
+    try:
+        return os.path.getsize(os.path.join(full_path, info.filename)) == info.file_size
+    except OSError:
+        return False
+
+
+def remove_entry(full_path, name):
+    path = os.path.join(full_path, name)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    # drop the directories the removal left empty
+    parent = os.path.dirname(path)
+    while parent != full_path and os.path.isdir(parent) and not os.listdir(parent):
+        os.rmdir(parent)
+        parent = os.path.dirname(parent)
+
+
+def sync_archive(local_path, full_file_path, tag, overrides=None):
+    """
+    Brings local_path/tag in line with the archive and removes the archive: entries whose
+    size or CRC changed are extracted, entries gone from the archive are deleted and
+    unchanged files are left alone. overrides (name -> bytes) are written over the
+    archive's entries and always rewritten on the next sync.
+    Returns the extraction stats of simple_ops plus 'unchanged' and 'removed' counts.
+    """
+    start = time.time()
+    overrides = overrides or {}
+    full_path = local_path + "/" + tag
+    manifest = load_manifest(tag)
+    if manifest is None or not os.path.isdir(full_path):
+        simple_ops.check_clean_path(local_path, tag)
+        manifest = {'files': {}}
+
+    members = simple_ops.archive_members(full_file_path, full_path)
+    changed = [info for info in members if not unchanged(full_path, manifest['files'].get(info.filename), info)]
+    names = set(info.filename for info in members)
+    removed = [name for name in manifest['files'] if name not in names]
+    for name in removed:
+        remove_entry(full_path, name)
+
+    # written files are out of the manifest until the extraction finished
+    for info in changed:
+        manifest['files'].pop(info.filename, None)
+    for name in removed:
+        del manifest['files'][name]
+    save_manifest(tag, manifest)
+
+    size, workers = simple_ops.extract_archive(full_file_path, full_path, changed)
+    simple_ops.write_files(full_path, overrides)
+    os.remove(full_file_path)
+
+    manifest['files'] = dict((info.filename, [info.file_size, None if info.filename in overrides else info.CRC])
+                             for info in members)
+    manifest['bytes'] = sum(info.file_size for info in members)
+    manifest['last_used'] = time.time()
+    save_manifest(tag, manifest)
+
+    stats = simple_ops.extraction_stats(tag, size, len(changed), workers, start)
+    stats['unchanged'] = len(members) - len(changed)
+    stats['removed'] = len(removed)
+    evict(local_path, tag)
+    return stats
+
+
+def evict(local_path, keep_tag):
+    """
+    Removes the least recently used workspaces until the store fits WORKSPACE_MAX_BYTES
+    """
+    with workspace_lock:
+        manifests = {}
+        if os.path.isdir(constants.WORKSPACE_MANIFEST_DIR):
+            for name in os.listdir(constants.WORKSPACE_MANIFEST_DIR):
+                if name.endswith(".json"):
+                    tag = name[:-len(".json")]
+                    manifest = load_manifest(tag)
+                    if manifest is not None:
+                        manifests[tag] = manifest
+
+        total = sum(m.get('bytes', 0) for m in manifests.values())
+        for tag in sorted(manifests, key=lambda t: manifests[t].get('last_used', 0)):
+            if total <= constants.WORKSPACE_MAX_BYTES:
+                break
+            if tag == keep_tag or tag in in_use:
+                continue
+            log.debug("Workspace %s evicted, %s bytes", tag, manifests[tag].get('bytes', 0))
+            remove_manifest(tag)
+            shutil.rmtree(os.path.join(local_path, tag), ignore_errors=True)
+            total -= manifests[tag].get('bytes', 0)
+
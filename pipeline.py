@@ -0,0 +1,303 @@
+import constants
+import kubbuilder_service
+import metrics
+import tracing
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from coralogger import get_default_logger
+
+log = get_default_logger()
+
+pools = dict((name, ThreadPoolExecutor(constants.PIPELINE_WORKERS[name]))
+             for name, stage in kubbuilder_service.STAGES)
+
+stats_lock = threading.Lock()
+queued = dict((name, 0) for name, stage in kubbuilder_service.STAGES)
+running = dict((name, 0) for name, stage in kubbuilder_service.STAGES)
+
+# Latest job per executor tag. Only one job per tag works on /tmp/nlu/<tag> at a time:
+# a newer job waits for the one it supersedes to reach a stage boundary.
+jobs_lock = threading.Lock()
+jobs_by_tag = {}
+# Recent jobs by request_id for the status endpoint, oldest dropped first
+jobs_by_id = OrderedDict()
+
+
+def submit(job, on_done):
+    """
+    Runs the job through kubbuilder_service.STAGES, each stage on its own pool,
+    and calls on_done(job) when it finished or failed ('error' is set then).
+    Returns the job that will serve on_done: a job for the same tag and archive
+    location that hasn't started downloading yet is reused, any other unfinished
+    job for the tag is superseded.
+    """
+    with jobs_lock:
+        current = jobs_by_tag.get(job['tag'])
+        if current is not None and same_payload(current, job):
+            current['callbacks'].append(on_done)
+            log.debug("Job %s coalesced into %s", job.get('request_id'), current.get('request_id'))
+            return current
+
+        job['callbacks'] = [on_done]
+        job['status'] = 'queued'
+        job['stages'] = {}
+        jobs_by_tag[job['tag']] = job
+        remember(job)
+        if current is None:
+            start = True
+        else:
+            start = supersede(current, job)
+
+    if start:
+        schedule(job, 0)
+    return job
+
+
+def submit_batch(jobs, on_done, on_batch_done=None):
+    """
+    Submits the jobs like submit(), except that the jobs of the batch wait for each
+    other before the deploy stage and are deployed together by
+    kubbuilder_service.stage_deploy_batch. on_done[i](job) is called when jobs[i]
+    finished and on_batch_done(jobs) once all of them did, with the jobs that served them.
+    Returns the serving jobs.
+    """
+    batch = {'lock': threading.Lock(), 'waiting': set(id(job) for job in jobs), 'ready': []}
+    finished = {'jobs': [None] * len(jobs), 'left': len(jobs)}
+
+    def item_done(i, job):
+        on_done[i](job)
+        with batch['lock']:
+            finished['jobs'][i] = job
+            finished['left'] -= 1
+            last = finished['left'] == 0
+        if last and on_batch_done is not None:
+            on_batch_done(finished['jobs'])
+
+    serving = []
+    for i, job in enumerate(jobs):
+        # set before submitting, the first jobs may reach the deploy stage before the last one is submitted
+        job['batch'] = batch
+        served = submit(job, lambda finished_job, i=i: item_done(i, finished_job))
+        if served is not job:
+            # coalesced into a job outside of the batch, which deploys on its own
+            batch_leave(job)
+        serving.append(served)
+    return serving
+
+
+def batch_arrive(job):
+    # the job reached the deploy stage, the last job of the batch to get there deploys them all
+    batch = job['batch']
+    job['stage'] = 'deploy'
+    job['status'] = 'waiting for batch'
+    with batch['lock']:
+        batch['waiting'].discard(id(job))
+        batch['ready'].append(job)
+    schedule_batch(batch)
+
+
+def batch_leave(job):
+    # the job won't reach the deploy stage (failed, superseded or coalesced)
+    batch = job.pop('batch')
+    with batch['lock']:
+        batch['waiting'].discard(id(job))
+    schedule_batch(batch)
+
+
+def schedule_batch(batch):
+    with batch['lock']:
+        if batch['waiting'] or not batch['ready']:
+            return
+        jobs = batch['ready']
+        batch['ready'] = []
+    for job in jobs:
+        job['status'] = 'queued'
+        job['queued_at'] = time.time()
+    with stats_lock:
+        queued['deploy'] += len(jobs)
+    pools['deploy'].submit(run_batch_deploy, jobs)
+
+
+def run_batch_deploy(jobs):
+    with stats_lock:
+        queued['deploy'] -= len(jobs)
+        running['deploy'] += len(jobs)
+    started = time.time()
+    for job in jobs:
+        job['status'] = 'running'
+        metrics.observe('kubbuilder_stage_wait_seconds', started - job['queued_at'], stage='deploy')
+    try:
+        with tracing.trace(jobs[0].get('request_id'), jobs[0].get('profile')), \
+                tracing.span("stage.deploy_batch", tags=[job['tag'] for job in jobs]):
+            kubbuilder_service.stage_deploy_batch(jobs)
+    except Exception:
+        error = traceback.format_exc()
+        log.error("Batch deploy of %s failed: %s", [job.get('request_id') for job in jobs], error)
+        # shared steps (connecting, the pod watch): jobs with an outcome of their own keep it
+        for job in jobs:
+            if 'result' not in job:
+                job.setdefault('error', error)
+    finally:
+        with stats_lock:
+            running['deploy'] -= len(jobs)
+
+    for job in jobs:
+        # each job's own run: until its reconcile failed or its rollout's outcome was known
+        ended = job.pop('deploy_finished', time.time())
+        job['stages']['deploy'] = {'wait': round(started - job['queued_at'], 3), 'run': round(ended - started, 3)}
+        job.pop('batch', None)
+        finish(job)
+
+
+def remember(job):
+    if job.get('request_id') is None:
+        return
+    jobs_by_id[job['request_id']] = job
+    while len(jobs_by_id) > constants.JOB_HISTORY_SIZE:
+        jobs_by_id.popitem(last=False)
+
+
+def get_job(request_id):
+    with jobs_lock:
+        job = jobs_by_id.get(request_id)
+        if job is None:
+            return None
+        return {
+            'request_id': request_id,
+            'tag': job['tag'],
+            'status': job['status'],
+            'stage': job.get('stage'),
+            'stages': dict(job['stages']),
+            'timings': dict(job.get('timings', {})),
+            'extraction': job.get('extraction'),
+            'superseded_by': job['superseded_by'].get('request_id') if 'superseded_by' in job else None,
+            'result': job.get('result'),
+            'error': job.get('error')}
+
+
+def same_payload(current, job):
+    # the archive at the location may have been overwritten since a started job downloaded it
+    not_started = 'waiting_for' in current or (current.get('stage') == 'download' and current['status'] == 'queued')
+    return not_started and current['executor_location'] == job['executor_location'] and \
+        current['host_path'] == job['host_path']
+
+
+def supersede(current, job):
+    # callers of the older job get the result of the newer one
+    job['callbacks'] = current['callbacks'] + job['callbacks']
+    current['callbacks'] = []
+    log.debug("Job %s superseded by %s", current.get('request_id'), job.get('request_id'))
+
+    if 'waiting_for' in current:
+        # never started: take its place behind the job it was waiting for
+        current['status'] = 'superseded'
+        current['superseded_by'] = job
+        predecessor = current.pop('waiting_for')
+        predecessor['successor'] = job
+        job['waiting_for'] = predecessor
+        if 'batch' in current:
+            batch_leave(current)
+        return False
+
+    current['superseded_by'] = job
+    if current.get('stage') == 'deploy':
+        # past the workspace and the image, only its rollout is left and the newer job will replace it
+        return True
+    current['successor'] = job
+    job['waiting_for'] = current
+    return False
+
+
+def schedule(job, index):
+    name = kubbuilder_service.STAGES[index][0]
+    job['stage'] = name
+    job['status'] = 'queued'
+    job['queued_at'] = time.time()
+    with stats_lock:
+        queued[name] += 1
+    pools[name].submit(run_stage, job, index)
+
+
+def run_stage(job, index):
+    name, stage = kubbuilder_service.STAGES[index]
+    with stats_lock:
+        queued[name] -= 1
+        running[name] += 1
+    started = time.time()
+    wait = started - job['queued_at']
+    metrics.observe('kubbuilder_stage_wait_seconds', wait, stage=name)
+    job['status'] = 'running'
+    try:
+        if 'superseded_by' not in job:
+            with tracing.trace(job.get('request_id'), job.get('profile')), tracing.span("stage." + name, tag=job['tag']):
+                stage(job)
+    except Exception:
+        job['error'] = traceback.format_exc()
+        log.error("Job %s failed in stage %s: %s", job.get('request_id'), name, job['error'])
+    finally:
+        with stats_lock:
+            running[name] -= 1
+        job['stages'][name] = {'wait': round(wait, 3), 'run': round(time.time() - started, 3)}
+
+    if 'superseded_by' in job:
+        log.debug("Job %s stopped at %s, superseded", job.get('request_id'), name)
+        kubbuilder_service.abandon_job(job)
+        finish(job)
+        return
+
+    if 'error' not in job and index + 1 < len(kubbuilder_service.STAGES):
+        if 'batch' in job and kubbuilder_service.STAGES[index + 1][0] == 'deploy':
+            batch_arrive(job)
+            return
+        schedule(job, index + 1)
+        return
+
+    finish(job)
+
+
+def finish(job):
+    if 'batch' in job:
+        batch_leave(job)
+
+    if 'superseded_by' in job:
+        job['status'] = 'superseded'
+    elif 'error' in job:
+        job['status'] = 'failed'
+    else:
+        job['status'] = 'done'
+    metrics.inc('kubbuilder_jobs_total', status=job['status'])
+
+    with jobs_lock:
+        if jobs_by_tag.get(job['tag']) is job:
+            del jobs_by_tag[job['tag']]
+        successor = job.pop('successor', None)
+        if successor is not None:
+            del successor['waiting_for']
+        callbacks = job['callbacks']
+        job['callbacks'] = []
+
+    if successor is not None:
+        schedule(successor, 0)
+
+    for on_done in callbacks:
+        try:
+            on_done(job)
+        except Exception:
+            log.error("Job %s completion handler failed: %s", job.get('request_id'), traceback.format_exc())
+
+
+def export_metrics():
+    for name, stats in get_stats().items():
+        metrics.set_gauge('kubbuilder_queue_depth', stats['queued'], stage=name)
+        metrics.set_gauge('kubbuilder_jobs_in_flight', stats['running'], stage=name)
+
+
+def get_stats():
+    with stats_lock:
+        return dict((name, {'queued': queued[name], 'running': running[name],
+                            'workers': constants.PIPELINE_WORKERS[name]})
+                    for name, stage in kubbuilder_service.STAGES)
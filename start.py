@@ -4,6 +4,13 @@ from tornado.ioloop import IOLoop
 
 from controller import app
 from coralogger import create_logger
+from tracing import create_trace_writer, instrument
+import importlib
+import pkgutil
+import callbacks
+import constants
+import kubbuilder_service
+import operations
 
 
 if __name__ == "__main__":
@@ -11,6 +18,14 @@ if __name__ == "__main__":
     http_server.listen(5000)
 
     log = create_logger(app)
+
+    if constants.TRACING_ENABLED:
+        create_trace_writer()
+        # every module of the operations package, so new ones are traced without being listed here
+        instrument([kubbuilder_service] + [importlib.import_module("operations." + name)
+                                           for _, name, _ in pkgutil.iter_modules(operations.__path__)])
+    # resumes deliveries left over from the previous run
+    callbacks.start_workers()
     log.info("Starting Flask App - KubBuilder")
     log.debug("Additional info about KubBuilder")
 
@@ -0,0 +1,93 @@
+import json
+import unittest
+
+import pytest
+
+client = pytest.importorskip("kubernetes.client")
+
+import operations.kuber_ops as kuber_ops
+import operations.reconcile_ops as reconcile_ops
+
+
+class Response(object):
+    # what ApiClient.deserialize reads from a REST response
+    def __init__(self, data):
+        self.data = json.dumps(data)
+
+
+def round_trip(resource, response_type, update=None):
+    # the object as the API returns it: serialized, optionally changed server side, and
+    # read back into the client's models, which type int-or-string fields as str
+    data = kuber_ops.serialize(resource)
+    if update is not None:
+        update(data)
+    return client.ApiClient().deserialize(Response(data), response_type)
+
+
+class ResourcePatchTest(unittest.TestCase):
+
+    def test_unchanged_service_is_not_patched(self):
+        service = kuber_ops.create_nlu_service_object("executor")
+        live = round_trip(service, 'V1Service')
+        self.assertIsNone(reconcile_ops.resource_patch('service', service, live))
+
+    def test_unchanged_ingress_is_not_patched(self):
+        ingress = kuber_ops.create_ingress_object("executor", "example.com")
+        live = round_trip(ingress, 'V1beta1Ingress')
+        self.assertIsNone(reconcile_ops.resource_patch('ingress', ingress, live))
+
+    def test_unchanged_hpa_is_not_patched(self):
+        hpa = kuber_ops.create_nlu_hpa_object("executor")
+        live = round_trip(hpa, 'V1HorizontalPodAutoscaler')
+        self.assertIsNone(reconcile_ops.resource_patch('hpa', hpa, live))
+
+    def test_unchanged_deployment_is_not_patched(self):
+        deployment = kuber_ops.create_nlu_deployment_object("repo:executor-1", None, "executor", 1024, mem_limit=2048)
+        live = round_trip(deployment, 'ExtensionsV1beta1Deployment')
+        self.assertIsNone(reconcile_ops.resource_patch('deployment', deployment, live))
+
+    def test_canonical_quantities_are_not_patched(self):
+        deployment = kuber_ops.create_nlu_deployment_object("repo:executor-1", None, "executor", 1024, mem_limit=2048)
+
+        def canonicalize(data):
+            resources = data['spec']['template']['spec']['containers'][0]['resources']
+            resources['requests']['memory'] = "1Gi"
+            resources['limits']['memory'] = "2Gi"
+
+        live = round_trip(deployment, 'ExtensionsV1beta1Deployment', canonicalize)
+        self.assertIsNone(reconcile_ops.resource_patch('deployment', deployment, live))
+
+    def test_changed_image_is_patched(self):
+        deployment = kuber_ops.create_nlu_deployment_object("repo:executor-2", None, "executor", 1024)
+        live = round_trip(
+            kuber_ops.create_nlu_deployment_object("repo:executor-1", None, "executor", 1024),
+            'ExtensionsV1beta1Deployment')
+        patch = reconcile_ops.resource_patch('deployment', deployment, live)
+        self.assertEqual(patch, {'spec': {'template': {'spec': {'containers': [
+            {'name': 'executor', 'image': 'repo:executor-2'}]}}}})
+
+    def test_dropped_env_var_replaces_the_list(self):
+        deployment = kuber_ops.create_nlu_deployment_object("repo:executor-1", None, "executor", 1024)
+
+        def add_env(data):
+            data['spec']['template']['spec']['containers'][0]['env'].append({'name': 'OLD', 'value': 'x'})
+
+        live = round_trip(deployment, 'ExtensionsV1beta1Deployment', add_env)
+        patch = reconcile_ops.resource_patch('deployment', deployment, live)
+        env = patch['spec']['template']['spec']['containers'][0]['env']
+        self.assertEqual(env[-1], {'$patch': 'replace'})
+        self.assertNotIn('OLD', [e.get('name') for e in env])
+
+    def test_reordered_env_is_not_patched(self):
+        secret = client.V1Secret(metadata=client.V1ObjectMeta(name="nlu-secret"), data={'B': 'Yg==', 'A': 'YQ=='})
+        deployment = kuber_ops.create_nlu_deployment_object("repo:executor-1", secret, "executor", 1024)
+
+        def reverse_env(data):
+            data['spec']['template']['spec']['containers'][0]['env'].reverse()
+
+        live = round_trip(deployment, 'ExtensionsV1beta1Deployment', reverse_env)
+        self.assertIsNone(reconcile_ops.resource_patch('deployment', deployment, live))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import constants
+import functools
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+context = threading.local()
+
+trace_logger = logging.getLogger(constants.TRACE_LOGGER_NAME)
+trace_logger.propagate = False
+
+
+def create_trace_writer():
+    """
+    Adds the rotating JSONL trace file handler to the trace logger
+    """
+
+    os.makedirs(constants.TRACE_FILE_ROOT, exist_ok=True)
+    handler = RotatingFileHandler(os.path.join(constants.TRACE_FILE_ROOT, constants.TRACE_FILE_PREFIX),
+                                  maxBytes=constants.TRACE_FILE_MAX_BYTES,
+                                  backupCount=constants.TRACE_FILE_NUM_BACKUPS)
+    handler.setFormatter(logging.Formatter(fmt="%(message)s"))
+    trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO)
+
+
+def write(record):
+    if not trace_logger.handlers:
+        return
+    trace_logger.info(json.dumps(record, default=str))
+
+
+@contextmanager
+def trace(request_id, profile=False):
+    """
+    Binds the spans opened by this thread to request_id, optionally sampling its stacks
+    """
+    previous = getattr(context, 'request_id', None)
+    context.request_id = request_id
+    context.stack = []
+    profiler = start_profiler(request_id) if profile else None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            stop_profiler(profiler)
+        context.request_id = previous
+
+
+@contextmanager
+def span(name, **attrs):
+    request_id = getattr(context, 'request_id', None)
+    if request_id is None:
+        # background threads (informers, watches) aren't part of a job
+        yield {}
+        return
+
+    record = {
+        'trace': request_id,
+        'span_id': uuid.uuid4().hex[:16],
+        'parent_id': context.stack[-1]['span_id'] if context.stack else None,
+        'name': name,
+        'start': time.time(),
+        'attrs': attrs}
+    context.stack.append(record)
+    try:
+        yield record['attrs']
+    except Exception as e:
+        record['error'] = "%s: %s" % (type(e).__name__, e)
+        raise
+    finally:
+        context.stack.pop()
+        record['end'] = time.time()
+        record['duration'] = round(record['end'] - record['start'], 6)
+        write(record)
+
+
+def annotate(**attrs):
+    """
+    Adds attributes, e.g. byte counts, to the innermost open span
+    """
+    stack = getattr(context, 'stack', None)
+    if stack:
+        stack[-1]['attrs'].update(attrs)
+
+
+def traced(func, module_name):
+    name = module_name + "." + func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def instrument(modules):
+    """
+    Wraps every public function defined in the given modules in a span
+    """
+    for module in modules:
+        module_name = module.__name__.split(".")[-1]
+        for name, obj in list(vars(module).items()):
+            if inspect.isfunction(obj) and obj.__module__ == module.__name__ and not name.startswith("_"):
+                setattr(module, name, traced(obj, module_name))
+
+
+def start_profiler(request_id):
+    profiler = {
+        'request_id': request_id,
+        'thread_id': threading.get_ident(),
+        'samples': {},
+        'stop': threading.Event(),
+        'start': time.time()}
+    profiler['thread'] = threading.Thread(target=sample_stacks, args=(profiler,), daemon=True)
+    profiler['thread'].start()
+    return profiler
+
+
+def sample_stacks(profiler):
+    while not profiler['stop'].wait(constants.PROFILE_INTERVAL):
+        frame = sys._current_frames().get(profiler['thread_id'])
+        if frame is None:
+            continue
+        stack = ";".join("%s:%s:%s" % (os.path.basename(f.filename), f.name, f.lineno)
+                         for f in traceback.extract_stack(frame))
+        profiler['samples'][stack] = profiler['samples'].get(stack, 0) + 1
+
+
+def stop_profiler(profiler):
+    profiler['stop'].set()
+    profiler['thread'].join()
+    write({
+        'trace': profiler['request_id'],
+        'type': 'profile',
+        'start': profiler['start'],
+        'end': time.time(),
+        'interval': constants.PROFILE_INTERVAL,
+        'samples': profiler['samples']})